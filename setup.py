@@ -29,5 +29,6 @@ setup(name='snappy',
       # -*- Entry points: -*-
       [console_scripts]
       snappy-client = snappy.client:main
+      snappy-compile = snappy.batch:main
       """,
       )
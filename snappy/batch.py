@@ -0,0 +1,206 @@
+"""Compile whole directories of projects.
+
+Every script of every sprite of every project is compiled on a pool
+of worker processes.  The generated programs are written to the
+output directory, along with a report.json holding the time taken and
+any error for each project and script.
+"""
+from os import path
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import astor
+
+from snappy import compiler
+from snappy import parser
+
+
+log = logging.getLogger(__file__)
+
+
+def find_projects(patterns):
+    """Return the project files matched by patterns.
+
+    A pattern is either a directory, which matches the .xml files in
+    it, or a glob.
+    """
+    filenames = []
+    seen = set()
+    for pattern in patterns:
+        if path.isdir(pattern):
+            pattern = path.join(pattern, '*.xml')
+        for filename in sorted(glob.glob(pattern)):
+            # A project matched by several patterns is compiled once.
+            if path.realpath(filename) not in seen:
+                seen.add(path.realpath(filename))
+                filenames.append(filename)
+    return filenames
+
+
+def output_names(filenames):
+    """Return the output directory name of each project in filenames.
+
+    It's the name of the project file without its extension, followed
+    by _2, _3... when an earlier project already has that name, so
+    projects with the same file name in different directories don't
+    overwrite each other's programs.
+    """
+    taken = set()
+    names = []
+    for filename in filenames:
+        base = name = path.splitext(path.basename(filename))[0]
+        count = 1
+        while name in taken:
+            count += 1
+            name = '%s_%s' % (base, count)
+        taken.add(name)
+        names.append(name)
+    return names
+
+
+def error_message(error):
+    return '%s: %s' % (error.__class__.__name__, error)
+
+
+def compile_project(filename, optimize=0):
+    """Compile every script of every sprite of the project in filename.
+
+    Errors are recorded in the result rather than raised, so one
+    broken project or script doesn't stop the others.
+    """
+    result = {'filename': filename,
+              'error': None,
+              'scripts': []}
+    start = time.time()
+    try:
+        handler = parser.parse(filename)
+        sprites = [len(scripts) for scripts in handler.index.sprite_scripts]
+    except Exception as e:
+        log.debug(traceback.format_exc())
+        result['error'] = error_message(e)
+        sprites = []
+    result['parse_time'] = time.time() - start
+
+    for sprite, scripts in enumerate(sprites):
+        for index in range(scripts):
+            script = {'sprite': sprite, 'index': index, 'error': None,
+                      'source': None}
+            start = time.time()
+            try:
+                module = compiler.compile_script(handler, index, optimize,
+                                                 sprite_idx=sprite)
+                script['source'] = astor.to_source(module)
+            except Exception as e:
+                log.debug(traceback.format_exc())
+                script['error'] = error_message(e)
+            script['time'] = time.time() - start
+            result['scripts'].append(script)
+    return result
+
+
+def compile_project_star(args):
+    return compile_project(*args)
+
+
+def write_programs(result, directory):
+    """Write the programs compiled for a project into directory.
+
+    The program of each script is sprite_<sprite>/main_<script>.py.
+    The sources are replaced by the names of the files written.
+    """
+    for script in result['scripts']:
+        source = script.pop('source')
+        script['program'] = None
+        if source is None:
+            continue
+        sprite_directory = path.join(directory,
+                                     'sprite_%s' % script['sprite'])
+        if not path.exists(sprite_directory):
+            os.makedirs(sprite_directory)
+        program = path.join(sprite_directory, 'main_%s.py' % script['index'])
+        with open(program, 'w') as file:
+            file.write(source)
+        script['program'] = program
+
+
+def failed(result):
+    return bool(result['error'] or
+                any(script['error'] for script in result['scripts']))
+
+
+def compile_projects(filenames, output, jobs=None, optimize=0):
+    """Compile filenames on jobs processes and return the report."""
+    start = time.time()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = []
+        tasks = [(filename, optimize) for filename in filenames]
+        compiled = pool.imap(compile_project_star, tasks)
+        for name, result in zip(output_names(filenames), compiled):
+            result['output'] = path.join(output, name)
+            write_programs(result, result['output'])
+            if failed(result):
+                log.warning("Failed to compile %s" % result['filename'])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return {'projects': results,
+            'failed': len([project for project in results
+                           if failed(project)]),
+            'time': time.time() - start}
+
+
+def main(argv=None):
+    import argparse
+
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argparser.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="Increase verbosity (specify multiple times for more).")
+    argparser.add_argument(
+        '-o', '--output', default='build',
+        help="The directory the programs and report are written to.")
+    argparser.add_argument(
+        '-j', '--jobs', default=multiprocessing.cpu_count(), type=int,
+        help="The number of worker processes.")
+    argparser.add_argument(
+        '-O', '--optimize', default=0, type=int,
+        help="The optimizer level, see snappy.optimizer.")
+    argparser.add_argument(
+        'projects', nargs='+',
+        help="Directories or globs of the project files.")
+
+    args = argparser.parse_args(argv)
+
+    log_level = logging.WARNING
+    if args.verbose == 1:
+        log_level = logging.INFO
+    elif args.verbose >= 2:
+        log_level = logging.DEBUG
+
+    logging.basicConfig(
+        level=log_level,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    filenames = find_projects(args.projects)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    report = compile_projects(filenames, args.output, args.jobs,
+                              args.optimize)
+    with open(path.join(args.output, 'report.json'), 'w') as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    log.info("Compiled %s projects, %s failed in %.2fs"
+             % (len(filenames), report['failed'], report['time']))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
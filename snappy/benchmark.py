@@ -0,0 +1,591 @@
+"""Benchmarks for the snappy compiler.
+
+Run the micro benchmarks with::
+
+    python -m snappy.benchmark
+
+The suite measures parsing, compiling and code generation of the
+sample programs and of generated projects, see synthetic_project.
+Save a baseline and compare later runs against it with::
+
+    python -m snappy.benchmark --suite --save baseline.json
+    python -m snappy.benchmark --suite --compare baseline.json
+
+Comparing exits with status 1 when anything got slower or used more
+memory than the tolerance allows.
+"""
+from StringIO import StringIO
+from os import path
+import ast
+import glob
+import json
+import multiprocessing
+import resource
+import sys
+import timeit
+
+import astor
+import lxml.etree
+import lxml.sax
+
+from snappy import compiler
+from snappy import parser
+from snappy import stdlib
+
+
+SAMPLE_PROGRAMS = path.join(path.dirname(__file__), 'tests', 'sample_programs')
+
+
+def sample_programs():
+    return sorted(glob.glob(path.join(SAMPLE_PROGRAMS, '*.xml')))
+
+
+DEEP_PROJECT = """\
+<project name="deep" app="Snap! 4.0, http://snap.berkeley.edu" version="1">
+  <stage name="Stage">
+    <sprites>
+      <sprite name="Sprite">
+        <scripts>
+%s
+        </scripts>
+      </sprite>
+    </sprites>
+  </stage>
+  <blocks/>
+</project>
+"""
+
+
+def deep_project(depth, width=1):
+    """Return a project with width scripts each nesting depth doIf blocks.
+
+    Every level adds two elements (the block and its script slot) to
+    the depth of the document.
+    """
+    script = '<script>%s</script>' % (
+        '<block s="doIf"><block s="reportTrue"/><script>' * depth +
+        '<block s="doSetVar"><l>i</l><l>1</l></block>' +
+        '</script></block>' * depth)
+    return DEEP_PROJECT % '\n'.join([script] * width)
+
+
+LOOP_SCRIPT = """\
+<script>
+  <block s="doSetVar"><l>i</l><l>0</l></block>
+  <block s="doUntil">
+    <block s="reportGreaterThan"><block var="i"/><l>%d</l></block>
+    <script>
+      <block s="doSetVar"><l>i</l>
+        <block s="reportSum">
+          <block s="reportSum"><block var="i"/><l>1</l></block>
+          <block s="reportSum"><l>0</l><l>0</l></block>
+        </block>
+      </block>
+      <block s="doSetVar"><l>positive</l>
+        <block s="reportNot">
+          <block s="reportLessThan"><block var="i"/><l>0</l></block>
+        </block>
+      </block>
+    </script>
+  </block>
+</script>
+"""
+
+
+def loop_project(iterations):
+    """Return a project with a single script counting to iterations."""
+    return DEEP_PROJECT % (LOOP_SCRIPT % iterations)
+
+
+COUNTER_PROJECT = """\
+<project name="counter" app="Snap! 4.0, http://snap.berkeley.edu" version="1">
+  <stage name="Stage">
+    <sprites>
+      <sprite name="Sprite">
+        <scripts>
+          <script>
+            <custom-block s="count to %%n"><l>%d</l></custom-block>
+          </script>
+        </scripts>
+      </sprite>
+    </sprites>
+  </stage>
+  <blocks>
+    <block-definition s="count to %%'n'" type="reporter" category="other">
+      <inputs><input type="%%n"/></inputs>
+      <script>
+        <block s="doDeclareVariables">
+          <list><l>i</l><l>total</l></list>
+        </block>
+        <block s="doSetVar"><l>i</l><l>0</l></block>
+        <block s="doSetVar"><l>total</l><l>0</l></block>
+        <block s="doUntil">
+          <block s="reportGreaterThan"><block var="i"/><block var="n"/></block>
+          <script>
+            <block s="doChangeVar"><l>i</l><l>1</l></block>
+            <block s="doChangeVar"><l>total</l><block var="i"/></block>
+          </script>
+        </block>
+        %s
+        <block s="doReport"><block var="total"/></block>
+      </script>
+    </block-definition>
+  </blocks>
+</project>
+"""
+
+# A ring that uses the loop variables, so they stay in the _locals dict.
+COUNTER_RING = """\
+<block s="reifyReporter">
+  <autolambda>
+    <block s="reportSum"><block var="i"/><block var="total"/></block>
+  </autolambda>
+  <list/>
+</block>
+"""
+
+
+def counter_project(iterations, ring=False):
+    """Return a project counting to iterations in a block definition.
+
+    With ring the counters are used by a ring, so they can't be
+    compiled to Python locals.
+    """
+    return COUNTER_PROJECT % (iterations, COUNTER_RING if ring else '')
+
+
+SYNTHETIC_PROJECT = """\
+<project name="bench" app="Snap! 4.0, http://snap.berkeley.edu" version="1">
+  <stage name="Stage">
+    <sprites>
+      <sprite name="Sprite">
+        <costumes><list>%(costumes)s</list></costumes>
+        <scripts>
+%(scripts)s
+        </scripts>
+      </sprite>
+    </sprites>
+  </stage>
+  <blocks>
+%(blocks)s
+  </blocks>
+</project>
+"""
+
+SYNTHETIC_COSTUME = """\
+<item><costume name="costume" image="data:image/png;base64,%s"/></item>"""
+
+SYNTHETIC_BLOCK = """\
+<block-definition s="bench %d %%'n'" type="reporter" category="other">
+  <inputs><input type="%%n"/></inputs>
+  <script>%s</script>
+</block-definition>"""
+
+
+def synthetic_call(index, argument):
+    return ('<custom-block s="bench %d %%n">%s</custom-block>'
+            % (index, argument))
+
+
+def synthetic_block(index, blocks, recursive):
+    """Return the definition of custom block index.
+
+    Every block but the last calls the next one, so the call graph is
+    a chain of all the blocks.  A recursive block counts its input
+    down to zero by calling itself in tail position first.
+    """
+    if index + 1 < blocks:
+        result = synthetic_call(index + 1, '<block var="n"/>')
+    else:
+        result = '<block var="n"/>'
+    report = ('<block s="doReport"><block s="reportSum">'
+              '<block var="n"/>%s</block></block>' % result)
+    if recursive:
+        countdown = synthetic_call(
+            index, '<block s="reportSum"><block var="n"/><l>-1</l></block>')
+        report = ('<block s="doIfElse">'
+                  '<block s="reportLessThan"><block var="n"/><l>1</l></block>'
+                  '<script>%s</script>'
+                  '<script><block s="doReport">%s</block></script>'
+                  '</block>' % (report, countdown))
+    return SYNTHETIC_BLOCK % (index, report)
+
+
+def synthetic_script(index, depth, blocks):
+    if blocks:
+        value = synthetic_call(index % blocks, '<l>3</l>')
+    else:
+        value = '<l>%d</l>' % index
+    return '<script>%s</script>' % (
+        '<block s="doIf"><block s="reportTrue"/><script>' * depth +
+        '<block s="doSetVar"><l>v</l>%s</block>' % value +
+        '</script></block>' * depth)
+
+
+def synthetic_project(scripts=10, depth=3, blocks=5, recursive=False,
+                      media=0):
+    """Return a generated project.
+
+    scripts is the number of scripts, each nesting depth doIf blocks
+    around a call of one of the blocks custom blocks, see
+    synthetic_block.  media is the size in bytes of the base64 data
+    of a costume, which the parser should skip.
+    """
+    return SYNTHETIC_PROJECT % {
+        'costumes': SYNTHETIC_COSTUME % ('A' * media) if media else '',
+        'scripts': '\n'.join(synthetic_script(index, depth, blocks)
+                             for index in range(scripts)),
+        'blocks': '\n'.join(synthetic_block(index, blocks, recursive)
+                            for index in range(blocks)),
+    }
+
+
+def saxify_parses(string):
+    """Parse a project with the old two pass front end.
+
+    The document is built into an lxml element tree and then replayed
+    into the BlockParser through lxml.sax.  Kept as a reference point
+    for the single pass front end in parser.parses.
+    """
+    tree = lxml.etree.parse(StringIO(string))
+    handler = parser.BlockParser()
+    lxml.sax.saxify(tree, handler)
+    return handler
+
+
+def best_of(func, arg, number, repeat):
+    """Return the best time in seconds for a single call of func(arg)."""
+    timer = timeit.Timer(lambda: func(arg))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def count_tags(node):
+    """Return the number of Tags in the tree below node."""
+    return sum(1 + count_tags(child) for child in node.children
+               if isinstance(child, parser.Tag))
+
+
+def node_size(node):
+    """Return the approximate number of bytes used by a single Tag."""
+    size = sys.getsizeof(node) + sys.getsizeof(node.attributes)
+    size += sys.getsizeof(node.children)
+    if not isinstance(getattr(type(node), 'text', None), property):
+        size += sys.getsizeof(node.text)
+    state = getattr(node, '__dict__', None)
+    if state is not None:
+        size += sys.getsizeof(state)
+        size += sum(sys.getsizeof(value) for value in state.values()
+                    if isinstance(value, list) and value is not node.children)
+    return size
+
+
+def tree_size(node):
+    """Return the approximate number of bytes used by the tree below node."""
+    size = 0
+    for child in node.children:
+        if isinstance(child, parser.Tag):
+            size += node_size(child) + tree_size(child)
+        else:
+            size += sys.getsizeof(child)
+    return size
+
+
+def bench_front_end(number=20, repeat=3):
+    print 'Front end (ms per parse)'
+    print '%-20s %10s %10s %8s' % ('program', 'saxify', 'target', 'speedup')
+    for filename in sample_programs():
+        xml = open(filename).read()
+        two_pass = best_of(saxify_parses, xml, number, repeat)
+        one_pass = best_of(parser.parses, xml, number, repeat)
+        print '%-20s %10.2f %10.2f %7.2fx' % (
+            path.basename(filename), two_pass * 1000, one_pass * 1000,
+            two_pass / one_pass)
+
+
+def bench_media(number=20, repeat=3):
+    print 'Media skipping (ms per parse, tags in tree)'
+    print '%-20s %10s %10s %8s %8s' % ('program', 'keep', 'skip',
+                                       'tags', 'tags')
+    for filename in sample_programs():
+        xml = open(filename).read()
+        keep = best_of(lambda x: parser.parses(x, code_tags=None),
+                       xml, number, repeat)
+        skip = best_of(parser.parses, xml, number, repeat)
+        print '%-20s %10.2f %10.2f %8d %8d' % (
+            path.basename(filename), keep * 1000, skip * 1000,
+            count_tags(parser.parses(xml, code_tags=None)),
+            count_tags(parser.parses(xml)))
+
+
+def bench_nesting(number=20, repeat=3, depths=(15, 30, 60, 120)):
+    print 'Nesting (us per element)'
+    print '%-20s %10s %10s' % ('depth', 'elements', 'target')
+    for depth in depths:
+        xml = deep_project(depth, width=120 // depth)
+        elements = count_tags(parser.parses(xml, code_tags=None))
+        one_pass = best_of(parser.parses, xml, number, repeat)
+        print '%-20d %10d %10.2f' % (depth, elements,
+                                     one_pass * 1000000 / elements)
+
+
+def bench_memory():
+    print 'Memory (KiB per parsed project)'
+    print '%-20s %10s %10s' % ('program', 'tree', 'tags')
+    for filename in sample_programs():
+        handler = parser.parse(filename)
+        print '%-20s %10.1f %10d' % (
+            path.basename(filename), tree_size(handler) / 1024.0,
+            count_tags(handler))
+
+
+def bench_entry_point(number=20, repeat=3, scripts=(1, 10, 50)):
+    print 'Entry point (ms per compile, bytes of source)'
+    print '%-20s %10s %10s %10s %10s' % ('scripts', 'all', 'entry',
+                                         'all', 'entry')
+
+    def compile_all(handler):
+        return handler.to_ast(handler.create_context(), 'main_0')
+
+    def compile_entry(handler):
+        return handler.to_ast(handler.create_context(), 'main_0',
+                              entry_point=0)
+
+    for width in scripts:
+        handler = parser.parses(deep_project(5, width))
+        full = best_of(compile_all, handler, number, repeat)
+        entry = best_of(compile_entry, handler, number, repeat)
+        print '%-20d %10.2f %10.2f %10d %10d' % (
+            width, full * 1000, entry * 1000,
+            len(astor.to_source(compile_all(handler))),
+            len(astor.to_source(compile_entry(handler))))
+
+
+def bench_optimize(number=20, repeat=3, levels=(0, 1, 2)):
+    print 'Optimizer (ms per run of a 1000 iteration loop)'
+    print '%-20s %10s %10s' % ('level', 'compile', 'run')
+    xml = loop_project(1000)
+    for level in levels:
+        compile_time = best_of(
+            lambda x: compiler.compile_code(x, 0, level), xml, number, repeat)
+        namespace = {}
+        exec compiler.compile_code(xml, 0, level) in namespace
+        run_time = best_of(lambda main: main(), namespace['main_0'],
+                           number, repeat)
+        print '%-20d %10.2f %10.2f' % (level, compile_time * 1000,
+                                       run_time * 1000)
+
+
+def bench_locals(number=20, repeat=3):
+    print 'Local variables (ms per run of a 1000 iteration loop)'
+    print '%-20s %10s' % ('variables', 'run')
+    for name, ring in (('dict', True), ('fast', False)):
+        namespace = {}
+        exec compiler.compile_code(counter_project(1000, ring), 0) in namespace
+        run_time = best_of(lambda main: main(), namespace['main_0'],
+                           number, repeat)
+        print '%-20s %10.2f' % (name, run_time * 1000)
+
+
+def copying_walk(items):
+    """Walk items with CDR implemented by slicing, as it used to be."""
+    data = list(items)
+    while data:
+        data = stdlib.doReport(data[1:])
+
+
+def linked_walk(items):
+    data = stdlib.List(items)
+    while data:
+        data = stdlib.reportCDR(data)
+
+
+def bench_lists(number=20, repeat=3, sizes=(100, 1000, 5000)):
+    print 'Lists (ms per walk with CDR)'
+    print '%-20s %10s %10s' % ('items', 'copying', 'linked')
+    for size in sizes:
+        items = range(size)
+        copying = best_of(copying_walk, items, number, repeat)
+        linked = best_of(linked_walk, items, number, repeat)
+        print '%-20d %10.2f %10.2f' % (size, copying * 1000, linked * 1000)
+
+
+# The synthetic projects of the suite, along with the sample programs.
+SUITE = [
+    ('small', dict(scripts=5, depth=2, blocks=5)),
+    ('wide', dict(scripts=200, depth=2, blocks=20)),
+    ('deep', dict(scripts=5, depth=100, blocks=5)),
+    ('blocks', dict(scripts=20, depth=2, blocks=200)),
+    ('recursive', dict(scripts=20, depth=2, blocks=50, recursive=True)),
+    ('media', dict(scripts=5, depth=2, blocks=5, media=4 * 1024 * 1024)),
+]
+
+# The measurements compared against a baseline, all lower is better.
+COMPARED = ('parse', 'compile', 'source', 'bytecode', 'peak')
+
+# Growth of the peak memory in KiB that is never a regression, small
+# projects barely move the peak.
+MEMORY_SLACK = 1024
+
+
+def suite_projects(suite=SUITE):
+    """Return (name, xml) of the sample programs and synthetic projects."""
+    projects = [(path.basename(filename), open(filename).read())
+                for filename in sample_programs()]
+    projects.extend((name, synthetic_project(**options))
+                    for name, options in suite)
+    return projects
+
+
+def compile_all(handler):
+    parser.clear_caches()
+    return handler.to_ast(handler.create_context(), 'main_0')
+
+
+def run_pipeline(xml):
+    """Parse xml and compile all its scripts to source and bytecode."""
+    module = compile_all(parser.parses(xml))
+    astor.to_source(module)
+    compile(ast.fix_missing_locations(module), 'job.py', 'exec')
+
+
+def measure_peak(queue, func, arg):
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func(arg)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start)
+
+
+def peak_memory(func, arg):
+    """Return the growth of the peak memory in KiB while calling func(arg).
+
+    func is called in a child process, so the peak isn't hidden by
+    memory this process has used before.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure_peak,
+                                      args=(queue, func, arg))
+    process.start()
+    try:
+        return queue.get()
+    finally:
+        process.join()
+
+
+def bench_project(xml, number=20, repeat=3):
+    """Return the measurements of the suite for one project.
+
+    Times are the best seconds per call of each phase, throughput is
+    in MB parsed and scripts compiled per second.
+    """
+    handler = parser.parses(xml)
+    module = compile_all(handler)
+    scripts = len(handler.script_elements())
+    fixed = ast.fix_missing_locations(module)
+    result = {
+        'bytes': len(xml),
+        'scripts': scripts,
+        'parse': best_of(parser.parses, xml, number, repeat),
+        'compile': best_of(compile_all, handler, number, repeat),
+        'source': best_of(astor.to_source, module, number, repeat),
+        'bytecode': best_of(lambda m: compile(m, 'job.py', 'exec'),
+                            fixed, number, repeat),
+        'peak': peak_memory(run_pipeline, xml),
+    }
+    result['parse_mb_s'] = len(xml) / result['parse'] / 1e6
+    result['scripts_s'] = scripts / (result['compile'] + result['bytecode'])
+    return result
+
+
+def run_suite(projects, number=20, repeat=3):
+    """Return the measurements of bench_project keyed by project name."""
+    return dict((name, bench_project(xml, number, repeat))
+                for name, xml in projects)
+
+
+def print_suite(results):
+    print 'Suite (ms per phase, MB/s parsed, scripts/s compiled, peak KiB)'
+    print '%-20s %9s %9s %9s %9s %9s %9s %9s' % (
+        'project', 'parse', 'compile', 'source', 'bytecode',
+        'MB/s', 'scripts/s', 'peak')
+    for name in sorted(results):
+        result = results[name]
+        print '%-20s %9.2f %9.2f %9.2f %9.2f %9.1f %9.0f %9d' % (
+            name, result['parse'] * 1000, result['compile'] * 1000,
+            result['source'] * 1000, result['bytecode'] * 1000,
+            result['parse_mb_s'], result['scripts_s'], result['peak'])
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Return the regressions of results against baseline.
+
+    A regression is a measurement more than tolerance, a fraction, over
+    the baseline, as a tuple (project, measurement, baseline, result).
+    Projects missing from either side are skipped.
+    """
+    regressions = []
+    for name in sorted(set(results) & set(baseline)):
+        for key in COMPARED:
+            old = baseline[name].get(key)
+            new = results[name].get(key)
+            if old is None or new is None:
+                continue
+            if key == 'peak' and new - old <= MEMORY_SLACK:
+                continue
+            if new > old * (1 + tolerance):
+                regressions.append((name, key, old, new))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+
+    argparser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    argparser.add_argument(
+        '-n', '--number', default=20, type=int,
+        help="Number of calls per timing run.")
+    argparser.add_argument(
+        '-r', '--repeat', default=3, type=int,
+        help="Number of timing runs, the best one is reported.")
+    argparser.add_argument(
+        '--suite', action='store_true',
+        help="Run the suite instead of the micro benchmarks.")
+    argparser.add_argument(
+        '--save', metavar='FILE',
+        help="Save the results of the suite as a baseline.")
+    argparser.add_argument(
+        '--compare', metavar='FILE',
+        help="Compare the results of the suite against a baseline.")
+    argparser.add_argument(
+        '--tolerance', default=0.1, type=float,
+        help="Fraction a measurement may exceed the baseline by.")
+
+    args = argparser.parse_args(argv)
+    if not (args.suite or args.save or args.compare):
+        bench_front_end(args.number, args.repeat)
+        bench_media(args.number, args.repeat)
+        bench_nesting(args.number, args.repeat)
+        bench_memory()
+        bench_entry_point(args.number, args.repeat)
+        bench_optimize(args.number, args.repeat)
+        bench_locals(args.number, args.repeat)
+        bench_lists(args.number, args.repeat)
+        return 0
+
+    results = run_suite(suite_projects(), args.number, args.repeat)
+    print_suite(results)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, key, old, new in regressions:
+            print 'Regression: %s %s %.6g -> %.6g' % (name, key, old, new)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
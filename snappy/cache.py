@@ -0,0 +1,167 @@
+"""Caches for compiled programs."""
+import collections
+import hashlib
+import imp
+import os
+import tempfile
+import threading
+
+
+class LRUCache(object):
+    """A mapping holding at most size items.
+
+    When it's full the least recently used item is discarded.  It can
+    be shared between threads.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# The version of the programs generated by snappy.  Bump it whenever
+# the compiler generates different code for the same project, so the
+# programs an older snappy left on disk are never used.
+PROGRAM_VERSION = 1
+
+
+def program_key(xml, block_idx, optimize=0, sprite_idx=0):
+    """Return the cache key of the program running script block_idx.
+
+    PROGRAM_VERSION and the bytecode magic number are part of the key,
+    so programs compiled by another snappy or Python version are never
+    used.
+    """
+    return digest_key(hashlib.sha1(xml), block_idx, optimize, sprite_idx)
+
+
+def digest_key(digest, block_idx, optimize=0, sprite_idx=0):
+    """Return program_key from digest, the sha1 of the project.
+
+    digest itself isn't changed.
+    """
+    digest = digest.copy()
+    digest.update('\0%s\0%s\0%s\0%s\0%s' % (
+        sprite_idx, block_idx, optimize, PROGRAM_VERSION, imp.get_magic()))
+    return digest.hexdigest()
+
+
+def touch(filename):
+    try:
+        os.utime(filename, None)
+    except OSError:
+        pass
+
+
+class ProgramCache(object):
+    """Compiled programs keyed by program_key.
+
+    Programs are the contents of .pyc files.  They are kept in a
+    bounded in memory LRU cache backed by one file per program in
+    directory, so they survive restarts of the server.  At most
+    disk_size files are kept, the least recently used ones are removed
+    when a program is stored.  Programs of other versions are never
+    read again, so they are among the first ones removed.  It can be
+    shared between threads.
+    """
+
+    def __init__(self, directory, size=128, disk_size=1024):
+        self.directory = directory
+        self.memory = LRUCache(size)
+        self.disk_size = disk_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pyc')
+
+    def get(self, key):
+        """Return the program stored under key, or None."""
+        program = self.memory.get(key)
+        if program is None:
+            filename = self.path(key)
+            if not os.path.exists(filename):
+                with self.lock:
+                    self.misses += 1
+                return None
+            with open(filename, 'rb') as file:
+                program = file.read()
+            # The modification time orders the files for prune.
+            touch(filename)
+            self.memory.set(key, program)
+            with self.lock:
+                self.disk_hits += 1
+        with self.lock:
+            self.hits += 1
+        return program
+
+    def set(self, key, program):
+        self.memory.set(key, program)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file first, so a crash or another thread
+        # writing the same program never leaves a truncated one behind.
+        fd, temporary = tempfile.mkstemp('.tmp', dir=self.directory)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(program)
+        os.rename(temporary, self.path(key))
+        self.prune()
+
+    def prune(self):
+        """Remove the least recently used files past disk_size."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pyc'):
+                filename = os.path.join(self.directory, name)
+                try:
+                    files.append((os.path.getmtime(filename), filename))
+                except OSError:
+                    # Removed by another thread.
+                    pass
+        files.sort()
+        for _, filename in files[:max(0, len(files) - self.disk_size)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'size': len(self.memory)}
@@ -2,19 +2,49 @@
 
 import json
 import logging
+import zlib
 
 import requests
 
 
 log = logging.getLogger(__file__)
 
+# The zlib window bits of each Content-Encoding.
+COMPRESSION = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
 
-def submit_program(url, program_source, sprite_idx, block_idx):
-    data = json.dumps(
-        {'sprite_idx': sprite_idx,
-         'block_idx': block_idx,
-         'project': program_source})
-    return requests.post(url + 'jobs', data=data)
+
+def compress(data, encoding):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, COMPRESSION[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def submit_program(url, program_source, sprite_idx, block_idx, raw=False,
+                   encoding=None):
+    """Post a project to the server.
+
+    With raw the project is posted as XML, with the indexes in the
+    query, otherwise it is wrapped in JSON.  encoding is gzip or
+    deflate to compress the upload.
+    """
+    if raw:
+        params = {'sprite_idx': sprite_idx, 'block_idx': block_idx}
+        headers = {'Content-Type': 'application/xml'}
+        data = program_source
+    else:
+        params = None
+        headers = {'Content-Type': 'application/json'}
+        data = json.dumps(
+            {'sprite_idx': sprite_idx,
+             'block_idx': block_idx,
+             'project': program_source})
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        data = compress(data, encoding)
+    return requests.post(url + 'jobs', data=data, params=params,
+                         headers=headers)
 
 
 def get_result(url, uuid):
@@ -33,11 +63,17 @@ def main():
         '--url', default='http://localhost:8888/',
         help="")
     parser.add_argument(
-        '--sprite-idx', default=0,
+        '--sprite-idx', default=0, type=int,
         help="The index of the sprite to execute")
     parser.add_argument(
-        '--block-idx', default=0,
+        '--block-idx', default=0, type=int,
         help="The index of the block to execute.")
+    parser.add_argument(
+        '--raw', action='store_true',
+        help="Post the project as XML instead of wrapping it in JSON.")
+    parser.add_argument(
+        '--compress', choices=sorted(COMPRESSION),
+        help="Compress the upload.")
     parser.add_argument(
         'filename',
         help="The file containing the project.")
@@ -55,7 +91,8 @@ def main():
         format='%(asctime)s %(name)s %(levelname)s %(message)s')
 
     resp = submit_program(args.url, open(args.filename).read(),
-                          args.sprite_idx, args.block_idx)
+                          args.sprite_idx, args.block_idx, args.raw,
+                          args.compress)
     uuid = resp.json()['id']
     resp = get_result(args.url, uuid)
     print resp.json()
@@ -0,0 +1,78 @@
+"""Compile Snap! projects into Python programs.
+
+The functions take an optional profile, which measures the time and
+memory of each phase of the compilation, see snappy.instrument.
+"""
+import ast
+import imp
+import marshal
+import struct
+import time
+
+import astor
+
+from snappy import instrument
+from snappy import optimizer
+from snappy import parser
+
+
+def compile_module(xml, block_idx, optimize=0,
+                   profile=instrument.NULL_PROFILE, sprite_idx=0):
+    """Return the module AST of a program that runs script block_idx.
+
+    The script is one of the sprite sprite_idx.  optimize is the
+    optimizer level, see snappy.optimizer.
+    """
+    with profile.phase('parse'):
+        handler = parser.parses(xml)
+    return compile_script(handler, block_idx, optimize, profile, sprite_idx)
+
+
+def compile_script(handler, block_idx, optimize=0,
+                   profile=instrument.NULL_PROFILE, sprite_idx=0):
+    """Return the module AST running script block_idx of a parsed project."""
+    ctx = handler.create_context(sprite_idx=int(sprite_idx))
+    module = handler.to_ast(ctx, 'main_%s' % block_idx,
+                            entry_point=int(block_idx), profile=profile,
+                            sprite_idx=int(sprite_idx))
+    with profile.phase('optimize'):
+        return optimizer.optimize(module, optimize)
+
+
+def compile_program(xml, block_idx, optimize=0,
+                    profile=instrument.NULL_PROFILE, sprite_idx=0):
+    """Return the source of a program that runs script block_idx."""
+    module = compile_module(xml, block_idx, optimize, profile, sprite_idx)
+    with profile.phase('source'):
+        return astor.to_source(module)
+
+
+def compile_code(xml, block_idx, optimize=0, filename='job.py',
+                 profile=instrument.NULL_PROFILE, sprite_idx=0):
+    """Return the code object of a program that runs script block_idx.
+
+    The module AST is compiled directly, without generating and
+    parsing the source first.
+    """
+    with profile.phase('parse'):
+        handler = parser.parses(xml)
+    return compile_script_code(handler, block_idx, optimize, filename,
+                               profile, sprite_idx)
+
+
+def compile_script_code(handler, block_idx, optimize=0, filename='job.py',
+                        profile=instrument.NULL_PROFILE, sprite_idx=0):
+    """Return the code object running script block_idx of a parsed project."""
+    module = compile_script(handler, block_idx, optimize, profile, sprite_idx)
+    with profile.phase('bytecode'):
+        return compile(ast.fix_missing_locations(module), filename, 'exec')
+
+
+def dump_pyc(code, profile=instrument.NULL_PROFILE):
+    """Return the contents of a .pyc file holding code.
+
+    The file can be run directly by the interpreter that wrote it.
+    """
+    with profile.phase('pyc'):
+        header = imp.get_magic() + struct.pack('<I', int(time.time()))
+        return header + marshal.dumps(code)
@@ -0,0 +1,115 @@
+"""Wall time and resident memory of the phases of a compilation.
+
+Pass a Profile to the compiler to find out where the time goes::
+
+    from snappy import compiler, instrument
+
+    profile = instrument.Profile()
+    compiler.compile_code(xml, 0, profile=profile)
+    for phase in profile.as_list():
+        print phase['phase'], phase['time'], phase['rss']
+
+The server records a profile for every job, see the profile of the
+job's state.
+
+The rss of a phase is only a rough hint: it's how much the resident
+memory of the whole process changed while the phase ran, not the
+memory the phase allocated.  Other threads, like the other jobs on the
+compile pool, change it too, and memory freed by Python is often kept
+by the process rather than returned to the system.
+"""
+import resource
+import time
+
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def resident_memory():
+    """Return the resident memory of the process in bytes.
+
+    Returns None where /proc isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class Phase(object):
+    """Measures a phase when used as a context manager."""
+    __slots__ = ('profile', 'name', 'start', 'rss')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.rss = resident_memory()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.start
+        rss = resident_memory()
+        if rss is not None and self.rss is not None:
+            rss -= self.rss
+        self.profile.record(self.name, elapsed, rss)
+
+
+class Profile(object):
+    """The time and rss of each phase of a compilation.
+
+    A phase measured more than once, like the compilation of each
+    custom block, is added up.  The rss is the change of the resident
+    memory of the process in bytes, it can be negative when memory is
+    returned to the system, see the module docstring for why it's only
+    a hint.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.order = []
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def record(self, name, elapsed, rss):
+        if name not in self.phases:
+            self.order.append(name)
+            self.phases[name] = {'phase': name, 'time': 0.0,
+                                 'rss': rss, 'count': 0}
+        phase = self.phases[name]
+        phase['time'] += elapsed
+        phase['count'] += 1
+        if phase['rss'] is not None and phase['count'] > 1:
+            phase['rss'] += rss
+
+    def as_list(self):
+        """Return the phases in the order they were first measured."""
+        return [dict(self.phases[name]) for name in self.order]
+
+
+class NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullProfile(object):
+    """A profile that measures nothing, used when none is given."""
+
+    def phase(self, name):
+        return NULL_PHASE
+
+    def as_list(self):
+        return []
+
+
+NULL_PHASE = NullPhase()
+NULL_PROFILE = NullProfile()
@@ -0,0 +1,230 @@
+"""Optimisation passes over the module AST built by the parser.
+
+Every reporter block is compiled to a call like stdlib.reportSum(a, b),
+which also records its result as the last reported value.  The passes
+here keep that behaviour where it can be observed:
+
+* Level 1 folds reporters whose inputs are all constants.
+* Level 2 also lowers simple reporters to native Python operators.
+
+The value recorded by a reporter is overwritten by the call around it
+when the reporter is one of the inputs of another reporter, since the
+outer call reports after all its inputs are evaluated.  Only reporters
+in that position are lowered, constant reporters anywhere else are
+replaced with stdlib.doReport(constant).
+
+The passes never modify the AST they are given, nodes that change are
+copied.  Parts of the AST can be shared with the block definition
+cache.
+"""
+import ast
+import operator
+
+from snappy import parser
+from snappy import stdlib
+
+
+# stdlib functions that always report a value after evaluating their
+# arguments.
+REPORTING = frozenset([
+    'doReport',
+    'reportAnd',
+    'reportCAR',
+    'reportCDR',
+    'reportCONS',
+    'reportEquals',
+    'reportFalse',
+    'reportGreaterThan',
+    'reportJoinWords',
+    'reportLessThan',
+    'reportListItem',
+    'reportNewList',
+    'reportNot',
+    'reportOr',
+    'reportStringSize',
+    'reportSum',
+    'reportTrue',
+])
+
+# Side effect free versions of the stdlib reporters that can be
+# evaluated at compile time.
+FOLDABLE = {
+    'reportAnd': lambda a, b: a and b,
+    'reportEquals': stdlib.equals,
+    'reportFalse': lambda: False,
+    'reportGreaterThan': operator.gt,
+    'reportLessThan': operator.lt,
+    'reportNot': operator.not_,
+    'reportOr': lambda a, b: a or b,
+    'reportStringSize': len,
+    'reportSum': operator.add,
+    'reportTrue': lambda: True,
+}
+
+
+def stdlib_function(node):
+    """Return the name of the stdlib function node calls, or None."""
+    if not isinstance(node, ast.Call):
+        return None
+    func = node.func
+    if (isinstance(func, ast.Attribute)
+            and isinstance(func.value, ast.Name)
+            and func.value.id == 'stdlib'):
+        return func.attr
+    return None
+
+
+def is_constant(node):
+    if isinstance(node, (ast.Num, ast.Str)):
+        return True
+    return isinstance(node, ast.Name) and node.id in ('True', 'False')
+
+
+def constant_value(node):
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Str):
+        return node.s
+    return node.id == 'True'
+
+
+def constant_node(value):
+    """Return the AST of value, or None if it can't be written as one."""
+    if isinstance(value, bool):
+        return ast.Name(str(value), ast.Load())
+    if isinstance(value, (int, long, float)):
+        return ast.Num(value)
+    if isinstance(value, basestring):
+        return ast.Str(value)
+    return None
+
+
+# Nodes whose evaluation can call code or raise, like reading an item
+# past the end of a list or a variable that isn't set.
+IMPURE = (ast.Call, ast.Subscript, ast.Attribute)
+
+
+def is_pure(node):
+    """Return True if evaluating node can't call any code or raise.
+
+    A script variable held in a Python local raises UnboundLocalError
+    when it's read before it's set, see parser.fast_local_name.
+    """
+    for child in ast.walk(node):
+        if isinstance(child, IMPURE):
+            return False
+        if (isinstance(child, ast.Name)
+                and child.id.startswith(parser.FAST_LOCAL_PREFIX)):
+            return False
+    return True
+
+
+def lower_compare(op):
+    def lower(a, b):
+        return ast.Compare(a, [op()], [b])
+    return lower
+
+
+def lower_equals(a, b):
+    # Text is compared case insensitively by stdlib.equals, so only
+    # comparisons against a number or boolean can use ==.
+    if any(is_constant(n) and not isinstance(n, ast.Str) for n in (a, b)):
+        return ast.Compare(a, [ast.Eq()], [b])
+    return None
+
+
+def lower_bool(op):
+    def lower(a, b):
+        # Both inputs are always evaluated by the reporter, a boolean
+        # operator may skip the second one.
+        if is_pure(b):
+            return ast.BoolOp(op(), [a, b])
+        return None
+    return lower
+
+
+# Reporters that can be replaced by a native operation when the value
+# they report isn't observable.
+LOWERABLE = {
+    'reportAnd': lower_bool(ast.And),
+    'reportEquals': lower_equals,
+    'reportGreaterThan': lower_compare(ast.Gt),
+    'reportLessThan': lower_compare(ast.Lt),
+    'reportNot': lambda a: ast.UnaryOp(ast.Not(), a),
+    'reportOr': lower_bool(ast.Or),
+    'reportSum': lambda a, b: ast.BinOp(a, ast.Add(), b),
+}
+
+
+class Optimizer(object):
+
+    def __init__(self, level=1):
+        self.level = level
+
+    def visit(self, node, dead=False):
+        """Return the optimised node.
+
+        dead is True when the value reported by node will be
+        overwritten by an enclosing reporter.
+        """
+        method = getattr(self, 'visit_' + node.__class__.__name__,
+                         self.generic_visit)
+        return method(node, dead)
+
+    def generic_visit(self, node, dead):
+        changes = {}
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                new_value = [self.visit(item, dead)
+                             if isinstance(item, ast.AST) else item
+                             for item in value]
+                if any(a is not b for a, b in zip(new_value, value)):
+                    changes[field] = new_value
+            elif isinstance(value, ast.AST):
+                new_value = self.visit(value, dead)
+                if new_value is not value:
+                    changes[field] = new_value
+        if not changes:
+            return node
+        fields = dict(ast.iter_fields(node))
+        fields.update(changes)
+        new_node = node.__class__(**fields)
+        return ast.copy_location(new_node, node)
+
+    def visit_Call(self, node, dead):
+        name = stdlib_function(node)
+        node = self.generic_visit(node, dead or name in REPORTING)
+        if name is None:
+            return node
+
+        if name in FOLDABLE and all(is_constant(a) for a in node.args):
+            try:
+                value = FOLDABLE[name](*[constant_value(a)
+                                         for a in node.args])
+            except Exception:
+                # Leave the error to be raised when the program runs.
+                value = None
+            else:
+                value = constant_node(value)
+            if value is not None:
+                if dead:
+                    return value
+                return parser.stdlib_call('doReport', [value])
+
+        if self.level >= 2 and dead and name in LOWERABLE:
+            try:
+                lowered = LOWERABLE[name](*node.args)
+            except TypeError:
+                # The block has the wrong number of inputs, leave it
+                # to fail when the program runs.
+                lowered = None
+            if lowered is not None:
+                return lowered
+        return node
+
+
+def optimize(module, level=1):
+    """Return an optimised copy of module, level 0 returns module."""
+    if level <= 0:
+        return module
+    return Optimizer(level).visit(module)
@@ -1,18 +1,48 @@
 import ast
-import copy
+import collections
+import hashlib
 import re
-import itertools
-from StringIO import StringIO
 
 import lxml.etree
-import lxml.sax
 import logging
 from xml.sax.handler import ContentHandler
 
+from snappy import cache
+from snappy import instrument
+
 LOG = logging.getLogger(__name__)
 
 LAST = -1
 
+# Elements whose children are filtered against the code tags, anything
+# directly inside one of these that isn't a code tag is skipped along
+# with its whole subtree.  This drops the base64 encoded thumbnail,
+# pentrails, costumes, sounds and media of a project without building
+# Tags for them.
+CONTAINER_TAGS = frozenset(['project', 'stage', 'sprite'])
+
+# Elements of a container that can affect the compiled program.
+CODE_TAGS = frozenset([
+    'stage',
+    'sprites',
+    'variables',
+    'blocks',
+    'scripts',
+    'headers',
+    'code',
+])
+
+# Compiled block definitions and scripts shared between all the
+# projects compiled by this process, see compile_unit.
+definition_cache = cache.LRUCache(1024)
+script_cache = cache.LRUCache(1024)
+
+
+def clear_caches():
+    definition_cache.clear()
+    script_cache.clear()
+
+
 SCRIPT_HEADER = """
 
 import logging
@@ -37,21 +67,6 @@ if '__file__' in locals():
 """
 
 
-def find_closest(state, rstack):
-    if state and rstack:
-        if state[LAST].name == rstack[0]:
-            rstack = rstack[1:]
-            if rstack:
-                state = state[LAST].children
-                return find_closest(state, rstack)
-            else:
-                return state[LAST], rstack
-        else:
-            return state, rstack
-    else:
-        return state, rstack
-
-
 def find_first(node, rstack):
     """Traverse the nodes and find the first node that
     matches the context listed in rstack."""
@@ -64,6 +79,69 @@ def find_first(node, rstack):
             return child
 
 
+def fingerprint(node):
+    """Return a digest of the subtree below node.
+
+    Equal subtrees have equal fingerprints, whichever project they
+    were parsed from and in whatever order their attributes were
+    written.
+    """
+    parts = []
+    fingerprint_parts(node, parts.append)
+    return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+def fingerprint_parts(node, append):
+    append(node.name)
+    if node.attributes:
+        append(repr(sorted(node.attributes.items())))
+    if node.text:
+        append(repr(node.text))
+    for child in node.children:
+        fingerprint_parts(child, append)
+    append('/')
+
+
+def compile_unit(unit_cache, key, ctx, compile):
+    """Return the AST compiled by compile(ctx), cached under key.
+
+    Units are block definitions and scripts, key is derived from
+    their fingerprint.  A cached unit is reused as long as the custom
+    blocks it calls still have the same signatures, so resubmitting a
+    project only compiles the units that changed and the ones calling
+    a block whose signature changed.  The returned AST may be shared
+    and must not be modified.
+    """
+    entry = unit_cache.get(key)
+    if entry is not None:
+        unit, signatures = entry
+        if all(ctx.custom_block_signature(name) == signature
+               for name, signature in signatures.items()):
+            for name in signatures:
+                ctx.lookupCustomBlock(name)
+            return unit
+    ctx = ctx.copy()
+    ctx.dependencies = set()
+    unit = compile(ctx)
+    signatures = dict([(name, ctx.custom_block_signature(name))
+                       for name in ctx.dependencies])
+    unit_cache.set(key, (unit, signatures))
+    return unit
+
+
+def native_str(value):
+    """Return value as a byte string if it is pure ASCII.
+
+    This matches what lxml.sax hands out, names generated from
+    attributes and text have to be byte strings to be used as AST
+    identifiers.
+    """
+    try:
+        return value.encode('ascii')
+    except UnicodeError:
+        return value
+
+
 def stdlib_call(fn, args):
     module = ast.Name('stdlib', ast.Load())
     func = ast.Attribute(value=module, attr=fn, ctx=ast.Load())
@@ -72,35 +150,196 @@ def stdlib_call(fn, args):
     return ast.Call(func, args, [], None, None)
 
 
+def is_report(node):
+    """Return True if node is the return of a doReport block."""
+    return (isinstance(node, ast.Return)
+            and isinstance(node.value, ast.Call)
+            and isinstance(node.value.func, ast.Attribute)
+            and isinstance(node.value.func.value, ast.Name)
+            and node.value.func.value.id == 'stdlib'
+            and node.value.func.attr == 'doReport')
+
+
+def always_reports(statements):
+    """Return True if every path through statements ends in a report.
+
+    The doReport wrapping a tail call can only be dropped when the
+    callee always reports, one that falls through reports None.
+    """
+    for node in statements:
+        if is_report(node):
+            return True
+        if (isinstance(node, ast.If) and always_reports(node.body)
+                and always_reports(node.orelse)):
+            return True
+    return False
+
+
+def tail_call(node, names):
+    """Return the call node returns if it calls a function in names.
+
+    This matches the statements doReport blocks compile to, which
+    return the value of a call through stdlib.doReport.
+    """
+    if not isinstance(node, ast.Return) or node.value is None:
+        return None
+    value = node.value
+    if is_report(node) and len(value.args) == 1:
+        value = value.args[0]
+    if (isinstance(value, ast.Call)
+            and isinstance(value.func, ast.Name)
+            and value.func.id in names
+            and not value.keywords
+            and value.starargs is None
+            and value.kwargs is None):
+        return value
+    return None
+
+
+def replace_tail_calls(statements, replace):
+    """Return statements with their tail calls replaced.
+
+    replace is called with every statement in tail position and
+    returns the statements replacing it, or None to keep it.  Only
+    branches of if statements are searched, statements in loops and
+    nested functions are left alone.  Nodes are copied rather than
+    modified, so statements is returned when nothing changed.
+    """
+    result = []
+    changed = False
+    for node in statements:
+        if isinstance(node, ast.If):
+            body = replace_tail_calls(node.body, replace)
+            orelse = replace_tail_calls(node.orelse, replace)
+            if body is not node.body or orelse is not node.orelse:
+                node = ast.copy_location(ast.If(node.test, body, orelse),
+                                         node)
+                changed = True
+            result.append(node)
+            continue
+        replacement = replace(node)
+        if replacement is None:
+            result.append(node)
+        else:
+            result.extend(replacement)
+            changed = True
+    return result if changed else statements
+
+
+def replace_calls(node, replace):
+    """Return a copy of node with replace applied to every call in it.
+
+    replace returns the node replacing a call, or the call itself.
+    Only the nodes that changed are copied.
+    """
+    changes = {}
+    for field, value in ast.iter_fields(node):
+        if isinstance(value, list):
+            new_value = [replace_calls(item, replace)
+                         if isinstance(item, ast.AST) else item
+                         for item in value]
+            if any(a is not b for a, b in zip(new_value, value)):
+                changes[field] = new_value
+        elif isinstance(value, ast.AST):
+            new_value = replace_calls(value, replace)
+            if new_value is not value:
+                changes[field] = new_value
+    if changes:
+        fields = dict(ast.iter_fields(node))
+        fields.update(changes)
+        node = ast.copy_location(node.__class__(**fields), node)
+    if isinstance(node, ast.Call):
+        node = replace(node)
+    return node
+
+
+def trampoline_tail_calls(module, names):
+    """Return module with mutually recursive tail calls trampolined.
+
+    names are the functions defined for custom blocks.  Functions on a
+    cycle of tail calls return a stdlib.TailCall instead of making
+    the tail call, and every other call to them goes through
+    stdlib.trampoline, so the depth of the recursion isn't limited by
+    the Python stack.
+    """
+    functions = dict((node.name, node) for node in module.body
+                     if isinstance(node, ast.FunctionDef)
+                     and node.name in names
+                     and always_reports(node.body))
+    callees = collections.OrderedDict()
+    for name, function in functions.items():
+        found = callees[name] = []
+
+        def collect(node):
+            call = tail_call(node, functions)
+            if call is not None:
+                found.append(call.func.id)
+        replace_tail_calls(function.body, collect)
+
+    recursive = CallGraph(callees).recursive()
+    if not recursive:
+        return module
+
+    def return_tail_call(node):
+        call = tail_call(node, recursive)
+        if call is None:
+            return None
+        return [ast.copy_location(ast.Return(stdlib_call(
+            'TailCall', [call.func] + call.args)), node)]
+
+    def trampoline(call):
+        if isinstance(call.func, ast.Name) and call.func.id in recursive:
+            return ast.copy_location(stdlib_call('trampoline', call), call)
+        return call
+
+    body = []
+    for node in module.body:
+        if isinstance(node, ast.FunctionDef) and node.name in recursive:
+            statements = replace_tail_calls(node.body, return_tail_call)
+            if statements is not node.body:
+                node = ast.copy_location(ast.FunctionDef(
+                    node.name, node.args, statements, node.decorator_list),
+                    node)
+        body.append(replace_calls(node, trampoline))
+    return ast.copy_location(ast.Module(body), module)
+
+
 class Tag(object):
+    """An element of the parsed project.
+
+    Nodes use __slots__ to keep parsed projects small, so subclasses
+    have to declare __slots__ as well, even if it's empty.  The text
+    of an element is gathered by the BlockParser when the element
+    ends.
+    """
+    __slots__ = ('name', 'attributes', 'children', 'text')
 
     def __init__(self, name, qname, attributes):
         self.name = qname
         self.attributes = attributes
         self.children = []
+        self.text = ''
 
     def __getitem__(self, item):
         return self.children.__getitem__(item)
 
-    @property
-    def text(self):
-        """Return all the text children as a string"""
-        return ''.join([child for child in self.children
-                        if isinstance(child, (str, unicode))])
-
     def __repr__(self):
         return "<Tag name='%s' %s>" % (self.name, self.attributes)
 
     def __str__(self):
         return self.text
 
+    def close(self):
+        """Called by the parser once the element and its children are
+        complete."""
+
 
 class BaseBlock(Tag):
+    __slots__ = ('block_name',)
 
     def __init__(self, name, qname, attributes):
         super(BaseBlock, self).__init__(name, qname, attributes)
         self.block_name = self.__class__.__name__
-        self.stack = []
 
     def find_child(self, path):
         state = find_first(self, path)
@@ -113,16 +352,48 @@ class BaseBlock(Tag):
 
 
 class Block(BaseBlock):
-    pass
+    __slots__ = ()
 
 
 class NotImplementedBlock(Block):
+    __slots__ = ()
+
     def to_ast(self, ctx):
         raise Exception("%s block isn't implemented" % self.attributes['s'])
 
 
+# Script variables that can be compiled to Python local variables have
+# to be valid identifiers.
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# The prefix of the Python locals holding script variables.
+FAST_LOCAL_PREFIX = '_v_'
+
+
+def fast_local_name(name):
+    """Return the name of the Python local holding script variable name."""
+    return FAST_LOCAL_PREFIX + name
+
+
+def variable_references(node):
+    """Return the names of the variables read or written below node."""
+    names = set()
+    stack = [node]
+    while stack:
+        for child in stack.pop().children:
+            if isinstance(child, NamedBlock):
+                names.add(child.block_name)
+            elif isinstance(child, (doSetVar, doChangeVar)):
+                names.add(child.children[0].text)
+            if isinstance(child, Tag):
+                stack.append(child)
+    return names
+
+
 def read_variable(ctx, name):
     if ctx.is_local_variable(name):
+        if name in ctx.fast_locals:
+            return ast.Name(fast_local_name(name), ast.Load())
         vname = ast.Name('_locals', ast.Load())
         index = ast.Index(ast.Str(name))
         var = ast.Subscript(vname, index, ast.Load())
@@ -138,6 +409,8 @@ def read_variable(ctx, name):
 
 def write_variable(ctx, name):
     if ctx.is_local_variable(name):
+        if name in ctx.fast_locals:
+            return ast.Name(fast_local_name(name), ast.Store())
         vname = ast.Name('_locals', ast.Load())
         index = ast.Index(ast.Str(name))
         var = ast.Subscript(vname, index, ast.Store())
@@ -152,6 +425,7 @@ def write_variable(ctx, name):
 
 
 class NamedBlock(Block):
+    __slots__ = ()
 
     def __init__(self, name, qname, attributes):
         super(NamedBlock, self).__init__(name, qname, attributes)
@@ -162,6 +436,7 @@ class NamedBlock(Block):
 
 
 class LiteralBlock(Tag):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         try:
@@ -176,6 +451,7 @@ class LiteralBlock(Tag):
 
 
 class List(Tag):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         return ast.List([v.to_ast(ctx)
@@ -184,12 +460,14 @@ class List(Tag):
 
 
 class Option(Tag):
+    __slots__ = ()
 
     def __repr__(self):
         return "<Option name='%s' %s>" % (self.name, self.attributes)
 
 
 class Input(Tag):
+    __slots__ = ()
 
     @property
     def type(self):
@@ -197,6 +475,7 @@ class Input(Tag):
 
 
 class BaseReporter(Block):
+    __slots__ = ()
 
     def report_ast(self, ctx):
         return [c.to_ast(ctx)
@@ -208,42 +487,43 @@ class BaseReporter(Block):
 
 
 class reportTrue(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportFalse(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportNot(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportAnd(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportOr(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportEquals(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportGreaterThan(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportLessThan(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportLetter(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportNewList(BaseReporter):
+    __slots__ = ()
 
     def report_ast(self, ctx):
         variables = self.find_child(['list'])
@@ -253,34 +533,35 @@ class reportNewList(BaseReporter):
 
 
 class reportCAR(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportCDR(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportCONS(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportJoinWords(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportListItem(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportStringSize(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class reportSum(BaseReporter):
-    pass
+    __slots__ = ()
 
 
 class doInsertInList(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         value = self.children[0].to_ast(ctx)
@@ -297,6 +578,7 @@ class doInsertInList(Block):
 
 
 class doAddToList(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         value = self.children[0].to_ast(ctx)
@@ -307,6 +589,7 @@ class doAddToList(Block):
 
 
 class doSetVar(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         var = self.children[0].text
@@ -315,6 +598,7 @@ class doSetVar(Block):
 
 
 class doChangeVar(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         name = self.children[0].text
@@ -324,23 +608,31 @@ class doChangeVar(Block):
 
 
 class doDeclareVariables(Block):
-    """Create script local variables."""
+    """Create script local variables.
+
+    The variables of a block definition are found when it's parsed,
+    see BlockDefinition.make_signature.
+    """
+    __slots__ = ()
+
+    def variables(self):
+        return [v.text for v in self.find_child(['list'])]
 
     def to_ast(self, ctx):
-        variables = self.find_child(['list'])
-        if ctx.function:
-            ctx.function.local_variables.extend([v.text for v in variables])
         # TODO Could return an ast node like (var1, var2) = (None, None)
         return None
 
 
 class doReport(BaseReporter):
+    __slots__ = ()
+
     def to_ast(self, ctx):
         value = super(doReport, self).to_ast(ctx)
         return ast.Return(value)
 
 
 class doIf(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         _if = ast.If(self.children[0].to_ast(ctx),
@@ -350,6 +642,7 @@ class doIf(Block):
 
 
 class doIfElse(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         _if = ast.If(self.children[0].to_ast(ctx),
@@ -359,39 +652,42 @@ class doIfElse(Block):
 
 
 class Evaluate(Block):
-    count = 0
+    """Call a ring, used by both the evaluate and doRun blocks.
 
-    def args_variable(self):
-        name = 'eval_' + str(self.count)
-        Evaluate.count += 1
-        storage = ast.Assign([ast.Name(name, ast.Store())],
-                             ast.List([], ast.Load()))
-        self.arg = ast.Name(name, ast.Load())
-        return storage
-
-    def add_argument(self, value):
-        func = ast.Attribute(value=self.arg, attr='append', ctx=ast.Load())
-        return ast.Expr(ast.Call(func, [value], [], None, None))
+    The inputs are usually a list of expressions, which is compiled to
+    a direct call.  When they are given as a single list value instead
+    the number of arguments is only known at run time, so the list is
+    passed with *args.
+    """
+    __slots__ = ()
 
     def to_ast(self, ctx):
-        ctx.body.append(self.args_variable())
-        args = []
         func = self.children[0].to_ast(ctx)
         func_name = self.children[0].block_name
-        for child in self.children[1].children:
-            ctx.body.append(self.add_argument(child.to_ast(ctx)))
+        inputs = self.children[1] if len(self.children) > 1 else None
 
         # If the thing being evaluated was passed in as an argument.
         # Then call it with all the args from the that were passed
         # into this function.  This supports calling looping functions.
-        if func_name in ctx.function.function_arguments:
+        if ctx.function and ctx.function.is_argument(func_name):
+            if isinstance(inputs, List):
+                # The inputs aren't passed, but they are still evaluated.
+                ctx.body.extend(ast.Expr(child.to_ast(ctx))
+                                for child in inputs.children)
             args = [ast.Name(arg, ast.Load())
                     for arg in ctx.function.function_arguments]
             return ast.Call(func, args, [], None, None)
-        return ast.Call(func, args, [], self.arg, None)
+
+        if inputs is None:
+            return ast.Call(func, [], [], None, None)
+        if isinstance(inputs, List):
+            args = [child.to_ast(ctx) for child in inputs.children]
+            return ast.Call(func, args, [], None, None)
+        return ast.Call(func, [], [], inputs.to_ast(ctx), None)
 
 
 class doUntil(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         _while = ast.While(
@@ -403,9 +699,11 @@ class doUntil(Block):
 
 
 class doForEach(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
-        ctx.inherited_scope.append(self.children[0].text)
+        ctx.inherited_scope = ctx.inherited_scope.extend(
+            [self.children[0].text])
         _for = ast.For(self.children[0].to_name(ast.Store()),
                        self.children[1].to_ast(ctx),
                        self.children[2].to_ast(ctx),
@@ -414,31 +712,29 @@ class doForEach(Block):
 
 
 class doWarp(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         return self.children[0].to_ast(ctx)
 
 
 class Autolambda(Block):
+    __slots__ = ()
 
     def to_ast(self, ctx):
         return self.children[0].to_ast(ctx)
 
 
 class Reify(Block):
-    count = 0
-
-    def gen_name(self):
-        name = 'reify_' + str(self.count)
-        Reify.count += 1
-        return name
+    __slots__ = ()
 
     def to_ast(self, ctx):
-        name = self.gen_name()
+        name = ctx.gen_name('reify')
         # TODO need to set the context variable here so that i can
         # flatten autolambda statements.
         ctx1 = ctx.copy()
-        ctx1.inherited_scope.extend([c.text for c in self.children[1]])
+        ctx1.inherited_scope = ctx1.inherited_scope.extend(
+            c.text for c in self.children[1])
 
         args = ast.arguments([ast.Name(arg.text, ast.Param())
                               for arg in self.children[1]],
@@ -458,6 +754,18 @@ class Reify(Block):
 
 
 class Script(BaseBlock):
+    __slots__ = ()
+
+    def code_fingerprint(self):
+        """Return the fingerprint of the blocks of the script.
+
+        Unlike fingerprint it leaves out the attributes of the script,
+        which are only its position in the editor.
+        """
+        parts = [self.name]
+        for child in self.children:
+            fingerprint_parts(child, parts.append)
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
 
     def has_body(self):
         return bool(self.children)
@@ -487,7 +795,16 @@ class Script(BaseBlock):
         return body or [ast.Pass()]
 
 
+# What the callers of a block definition are compiled from, and the
+# variables it declares.
+Signature = collections.namedtuple(
+    'Signature',
+    ['name', 'function_name', 'arguments', 'argument_types', 'block_id',
+     'local_variables'])
+
+
 class BlockDefinition(BaseBlock):
+    __slots__ = ('type', 'category', 'inner_functions', '_signature')
 
     def __init__(self, name, qname, attributes):
         super(BlockDefinition, self).__init__(name, qname, attributes)
@@ -495,20 +812,31 @@ class BlockDefinition(BaseBlock):
         self.type = attributes['type']
         self.category = attributes['category']
         self.inner_functions = []
-        self.local_variables = []
+        self._signature = None
 
     def to_ast(self, ctx):
-        ctx = ctx.copy()
+        """Return the function definition of this block.
+
+        Definitions are cached by their fingerprint, see compile_unit.
+        """
+        return compile_unit(definition_cache, fingerprint(self), ctx,
+                            self.compile)
+
+    def compile(self, ctx):
         ctx.function = self
+        ctx.variables = ctx.variables.extend(self.local_variables)
+        ctx.name_counts = {}
+        ctx.fast_locals = self.fast_locals(ctx)
         name = self.function_name
         args = ast.arguments([ast.Name(arg, ast.Param())
                               for arg in self.function_arguments],
                              None, None, [])
         script = self.find_child(['script'])
         script_ast = script.to_ast(ctx)
-        vars = [ast.Global(['_globals']),
-                ast.Assign([ast.Name('_locals', ast.Store())],
-                           ast.Dict([], []))]
+        vars = [ast.Global(['_globals'])]
+        if self.local_variables - ctx.fast_locals:
+            vars.append(ast.Assign([ast.Name('_locals', ast.Store())],
+                                   ast.Dict([], [])))
 
         if script.has_body():
             # Put any inner functions at the start of the body.  This has
@@ -516,46 +844,146 @@ class BlockDefinition(BaseBlock):
             body = vars + self.inner_functions + script_ast
         else:
             body = script_ast
-        return ast.FunctionDef(name, args, body, [])
+        return ast.FunctionDef(name, args, self.loop_tail_calls(body), [])
 
-    def custom_block_id(self):
-        inputs = list(reversed(self.function_argument_types))
-        name_parts = []
-        for a in self.block_name.split(' '):
-            if a.startswith('%'):
-                name_parts.append(inputs.pop())
+    def loop_tail_calls(self, body):
+        """Return body with the tail calls to itself turned into a loop.
+
+        The arguments are assigned the values of the call and the loop
+        starts over.  Definitions with nested functions are left alone,
+        since the functions would see the arguments change, and so are
+        definitions that can fall through without a report.
+        """
+        name = self.function_name
+        arguments = self.function_arguments
+        if not always_reports(body):
+            return body
+        for statement in body:
+            if any(isinstance(node, (ast.FunctionDef, ast.Lambda))
+                   for node in ast.walk(statement)):
+                return body
+
+        def loop(node):
+            call = tail_call(node, [name])
+            if call is None or len(call.args) != len(arguments):
+                return None
+            statements = [ast.Continue()]
+            if arguments:
+                targets = ast.Tuple([ast.Name(argument, ast.Store())
+                                     for argument in arguments],
+                                    ast.Store())
+                statements.insert(0, ast.Assign(
+                    [targets], ast.Tuple(call.args, ast.Load())))
+            return statements
+
+        statements = replace_tail_calls(body, loop)
+        if statements is body:
+            return body
+        declarations = [node for node in statements
+                        if isinstance(node, ast.Global)]
+        statements = [node for node in statements
+                      if not isinstance(node, ast.Global)]
+        if not isinstance(statements[LAST], ast.Return):
+            statements.append(ast.Return(None))
+        return declarations + [ast.While(ast.Name('True', ast.Load()),
+                                         statements, [])]
+
+    def fast_locals(self, ctx):
+        """Return the script variables that can be Python locals.
+
+        A variable declared by the definition stays in the _locals dict
+        when it's used inside a ring or a script passed to a custom
+        block, which are compiled to nested functions that can't assign
+        to the locals of this one, or when it's passed to an %upvar.
+        """
+        escaped = set()
+        stack = [self.find_child(['script'])]
+        while stack:
+            node = stack.pop()
+            for child in node.children:
+                if isinstance(child, Reify):
+                    escaped.update(variable_references(child))
+                elif isinstance(child, CustomBlock):
+                    escaped.update(child.escaped_variables(ctx))
+                if isinstance(child, Tag):
+                    stack.append(child)
+        return frozenset(name for name in self.local_variables - escaped
+                         if IDENTIFIER.match(name))
+
+    def close(self):
+        self._signature = self.make_signature()
+
+    def make_signature(self):
+        inputs = find_first(self, ['inputs'])
+        types = tuple(i.type for i in inputs.children) if inputs else ()
+        arguments = []
+        id_parts = []
+        remaining = list(reversed(types))
+        for part in self.block_name.split(' '):
+            if part.startswith('%'):
+                arguments.append(part[1:].strip("'"))
+                id_parts.append(remaining.pop() if remaining else part)
             else:
-                name_parts.append(a)
-        return ' '.join(name_parts)
+                id_parts.append(part)
+        return Signature(
+            name=self.block_name,
+            function_name=re.sub('[^0-9a-zA-Z]+', '_', str(self.block_name)),
+            arguments=tuple(arguments),
+            argument_types=types,
+            block_id=' '.join(id_parts),
+            local_variables=self.declared_variables())
+
+    def declared_variables(self):
+        """Return the script variables declared anywhere in the block."""
+        declared = set()
+        stack = [self]
+        while stack:
+            for child in stack.pop().children:
+                if isinstance(child, doDeclareVariables):
+                    declared.update(child.variables())
+                if isinstance(child, Tag):
+                    stack.append(child)
+        return frozenset(declared)
+
+    @property
+    def signature(self):
+        """The parts of the definition its callers are compiled from.
+
+        It's computed when the element is closed by the parser, so it
+        doesn't depend on what was compiled or cached before.
+        """
+        if self._signature is None:
+            self._signature = self.make_signature()
+        return self._signature
+
+    def custom_block_id(self):
+        return self.signature.block_id
 
     @property
     def function_name(self):
-        fn = re.sub('[^0-9a-zA-Z]+', '_', str(self.block_name))
-        return fn
+        return self.signature.function_name
 
     @property
     def function_arguments(self):
-        args = [a[1:].strip("'") for a in self.block_name.split(' ')
-                if a.startswith('%')]
-        return args
+        return list(self.signature.arguments)
 
     @property
     def function_argument_types(self):
-        return [i.type for i in self.find_child(['inputs']).children]
+        return self.signature.argument_types
 
     def is_argument(self, name):
-        if name in self.function_arguments:
-            return True
-        return False
+        return name in self.signature.arguments
+
+    @property
+    def local_variables(self):
+        return self.signature.local_variables
 
     def is_local_variable(self, name):
-        if name in self.local_variables:
-            return True
-        return False
+        return name in self.signature.local_variables
 
 
 class CustomBlock(BaseBlock):
-    counter = itertools.count().next
+    __slots__ = ()
 
     def __init__(self, name, qname, attributes):
         super(CustomBlock, self).__init__(name, qname, attributes)
@@ -564,7 +992,7 @@ class CustomBlock(BaseBlock):
     def to_func(self, ctx, func, body):
         """Append the custom block as a function into the parent functions
         scope."""
-        func_name = 'custom_block_' + str(self.counter())
+        func_name = ctx.gen_name('custom_block')
         args = ast.arguments([ast.Name(arg, ast.Param())
                               for arg in func.function_arguments],
                              None, None, [])
@@ -572,15 +1000,33 @@ class CustomBlock(BaseBlock):
         ctx.body.append(fn)
         return func_name
 
+    def escaped_variables(self, ctx):
+        """Return the variables of the caller this block can change."""
+        names = set()
+        func = ctx.custom_blocks.get(self.block_name)
+        if func is None:
+            return names
+        for arg, type in zip(self.children, func.function_argument_types):
+            if isinstance(arg, Script):
+                names.update(variable_references(arg))
+            elif type == '%upvar':
+                names.add(arg.text)
+        return names
+
     def to_ast(self, ctx):
         func = ctx.lookupCustomBlock(self.block_name)
         args = []
         for arg, type in zip(self.children, func.function_argument_types):
             if isinstance(arg, Script):
+                # The script is a function nested in the caller, its
+                # variables are the ones of the caller.  Only the
+                # arguments of the callee are passed to it.
                 ctx1 = ctx.copy()
                 ctx1.function = func
-                ctx1.variables.extend(ctx.function.local_variables)
-                ctx1.inherited_scope.extend(ctx.function.function_arguments)
+                ctx1.fast_locals = frozenset()
+                if ctx.function:
+                    ctx1.inherited_scope = ctx1.inherited_scope.extend(
+                        ctx.function.signature.arguments)
                 arg_ast = arg.to_ast(ctx1)
             else:
                 arg_ast = arg.to_ast(ctx)
@@ -711,26 +1157,80 @@ builtin_blocks = {
 }
 
 
+class Scope(object):
+    """An immutable set of names, inside the scope it's nested in.
+
+    Adding names creates a new scope linked to this one, so copies of
+    a Context can share their scopes.
+    """
+    __slots__ = ('names', 'parent')
+
+    def __init__(self, names=(), parent=None):
+        self.names = frozenset(names)
+        self.parent = parent
+
+    def __contains__(self, name):
+        scope = self
+        while scope is not None:
+            if name in scope.names:
+                return True
+            scope = scope.parent
+        return False
+
+    def extend(self, names):
+        """Return this scope with names added to it."""
+        names = frozenset(names)
+        if not names:
+            return self
+        return Scope(names, self)
+
+
+EMPTY_SCOPE = Scope()
+
+
 class Context(object):
     def __init__(self, custom_blocks=None, function=None, module=None,
-                 used_custom_blocks=None, variables=[], inherited_scope=[],
-                 body=None):
+                 variables=EMPTY_SCOPE,
+                 inherited_scope=EMPTY_SCOPE, body=None, dependencies=None,
+                 fast_locals=frozenset(), name_counts=None):
         self.custom_blocks = custom_blocks
         self.function = function
         self.module = module
-        self.variables = list(variables)
-        self.inherited_scope = list(inherited_scope)
+        self.variables = variables
+        self.inherited_scope = inherited_scope
         self.body = None
-        self.used_custom_blocks = used_custom_blocks
+        # The names of the custom blocks looked up while compiling a
+        # block definition.
+        self.dependencies = dependencies
+        # The local variables of the function that are compiled to
+        # Python locals, see BlockDefinition.fast_locals.
+        self.fast_locals = fast_locals
+        # The number of names generated for each prefix in the function
+        # being compiled, shared by all the copies of the context.
+        self.name_counts = {} if name_counts is None else name_counts
 
     def lookupCustomBlock(self, name):
-        if name not in self.used_custom_blocks:
-            self.used_custom_blocks.append(name)
+        if self.dependencies is not None:
+            self.dependencies.add(name)
         if name not in self.custom_blocks:
             raise Exception("Block '%s' not found in: %s"
                             % (name, self.custom_blocks.keys()))
         return self.custom_blocks[name]
 
+    def gen_name(self, prefix):
+        """Return a new name for a function nested in this one.
+
+        Names are numbered per function, so a function always compiles
+        to the same code whatever was compiled before it.
+        """
+        count = self.name_counts.get(prefix, 0)
+        self.name_counts[prefix] = count + 1
+        return '%s_%s' % (prefix, count)
+
+    def custom_block_signature(self, name):
+        block = self.custom_blocks.get(name)
+        return block.signature if block is not None else None
+
     def copy(self):
         kwargs = vars(self).copy()
         return Context(**kwargs)
@@ -741,11 +1241,13 @@ class Context(object):
         return body
 
     def is_local_variable(self, name):
-        if name in self.variables:
-            return True
-        if self.function and self.function.is_local_variable(name):
-            return True
-        return False
+        """Return whether name is a local of the function being compiled.
+
+        The locals of a block definition are added to variables when
+        it's compiled, so the scripts nested in it see them whatever
+        block they are passed to.
+        """
+        return name in self.variables
 
     def is_argument(self, name):
         if name in self.inherited_scope:
@@ -755,25 +1257,253 @@ class Context(object):
         return False
 
 
-class BlockParser(ContentHandler):
+def custom_block_calls(node):
+    """Return the ids of the custom blocks called below node.
+
+    They are in the order of their first call in the document.
+    """
+    calls = collections.OrderedDict()
+    stack = [node]
+    while stack:
+        for child in reversed(stack.pop().children):
+            if isinstance(child, CustomBlock):
+                calls[child.block_name] = None
+            if isinstance(child, Tag):
+                stack.append(child)
+    return calls.keys()
+
+
+class CallGraph(object):
+    """The calls between the custom blocks of a project.
+
+    callees maps the name of each block to the names of the blocks it
+    calls.  Calls to names that aren't in callees are ignored.
+    Results that depend on an order follow the order of the names in
+    callees when it's an OrderedDict.
+    """
+
+    def __init__(self, callees):
+        self._callees = collections.OrderedDict(
+            (name, tuple(callee for callee in calls if callee in callees))
+            for name, calls in callees.items())
+        self._position = dict((name, position) for position, name
+                              in enumerate(self._callees))
+        self._callers = None
+        self._components = None
+
+    @classmethod
+    def from_blocks(cls, custom_blocks):
+        """Return the graph of the calls made by the block definitions."""
+        return cls(collections.OrderedDict(
+            (name, custom_block_calls(block))
+            for name, block in custom_blocks.items()))
+
+    def __contains__(self, name):
+        return name in self._callees
+
+    def __iter__(self):
+        return iter(self._callees)
+
+    def callees(self, name):
+        """Return the blocks called by name."""
+        return self._callees[name]
+
+    def callers(self, name):
+        """Return the blocks that call name."""
+        if self._callers is None:
+            self._callers = dict((caller, []) for caller in self._callees)
+            for caller, callees in self._callees.items():
+                for callee in callees:
+                    self._callers[callee].append(caller)
+        return tuple(self._callers[name])
+
+    def reachable(self, names):
+        """Return the blocks in names and the ones they call in turn."""
+        seen = set()
+        stack = [name for name in names if name in self._callees]
+        while stack:
+            name = stack.pop()
+            if name not in seen:
+                seen.add(name)
+                stack.extend(self._callees[name])
+        return seen
+
+    def components(self):
+        """Return the strongly connected components of the graph.
+
+        A component is a tuple of the blocks that can call each other.
+        The components are returned callees first, found with Tarjan's
+        algorithm without recursion so long chains of calls are fine.
+        """
+        if self._components is not None:
+            return self._components
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in self._callees:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self._callees[root]))]
+            while work:
+                name, callees = work[LAST]
+                for callee in callees:
+                    if callee not in index:
+                        index[callee] = lowlink[callee] = len(index)
+                        stack.append(callee)
+                        on_stack.add(callee)
+                        work.append((callee, iter(self._callees[callee])))
+                        break
+                    elif callee in on_stack:
+                        lowlink[name] = min(lowlink[name], index[callee])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[LAST][0]
+                        lowlink[caller] = min(lowlink[caller], lowlink[name])
+                    if lowlink[name] == index[name]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == name:
+                                break
+                        components.append(tuple(
+                            sorted(component, key=self._position.get)))
+        self._components = components
+        return components
+
+    def recursive(self):
+        """Return the blocks that can end up calling themselves."""
+        names = set()
+        for component in self.components():
+            name = component[0]
+            if len(component) > 1 or name in self._callees[name]:
+                names.update(component)
+        return frozenset(names)
+
+    def sorted(self, names):
+        """Return names ordered so blocks come after the ones they call.
+
+        Blocks that call each other are in the order of the graph.
+        """
+        names = set(names)
+        return [name for component in self.components()
+                for name in component if name in names]
+
+
+# Where the elements recorded by the ProjectIndex are in a project.
+SPRITE_PATH = ['project', 'stage', 'sprites']
+BLOCKS_PATH = ['project', 'blocks']
+SPRITE_BLOCKS_PATH = SPRITE_PATH + ['sprite', 'blocks']
+
+
+class ProjectIndex(object):
+    """The sprites and block definitions of a project.
+
+    The BlockParser adds them as they are parsed, so a script can be
+    found without walking the tree.  Scripts are addressed by the index
+    of their sprite and their index in the sprite.  Block definitions
+    are either global to the project or local to a sprite.
+    """
 
     def __init__(self):
+        self.sprites = []
+        # The script elements of each sprite.
+        self.sprite_scripts = []
+        # The project's block definitions by their custom block id.
+        self.custom_blocks = collections.OrderedDict()
+        # The block definitions local to each sprite.
+        self.sprite_blocks = []
+        # The definitions of the sprite being parsed.
+        self.open_sprite_blocks = collections.OrderedDict()
+
+    def add_sprite(self, sprite):
+        scripts = find_first(sprite, ['scripts'])
+        self.sprites.append(sprite)
+        self.sprite_scripts.append(scripts.children if scripts else [])
+        self.sprite_blocks.append(self.open_sprite_blocks)
+        self.open_sprite_blocks = collections.OrderedDict()
+
+    def add_block_definition(self, definition):
+        self.custom_blocks[definition.custom_block_id()] = definition
+
+    def add_sprite_block_definition(self, definition):
+        """Add a definition of the sprite that is being parsed."""
+        self.open_sprite_blocks[definition.custom_block_id()] = definition
+
+    def sprite_custom_blocks(self, sprite_idx=0):
+        """Return the block definitions seen by sprite sprite_idx.
+
+        The blocks of the sprite come first and hide the project's
+        blocks of the same id.
+        """
+        if sprite_idx < len(self.sprite_blocks):
+            local = self.sprite_blocks[sprite_idx]
+        else:
+            local = None
+        if not local:
+            return self.custom_blocks
+        blocks = collections.OrderedDict(local)
+        for name, definition in self.custom_blocks.items():
+            blocks.setdefault(name, definition)
+        return blocks
+
+    def scripts(self, sprite_idx=0):
+        """Return the script elements of sprite sprite_idx.
+
+        A project without sprites has no scripts.
+        """
+        if not self.sprites and sprite_idx == 0:
+            return []
+        try:
+            return self.sprite_scripts[sprite_idx]
+        except IndexError:
+            raise Exception("Sprite %s not found, the project has %s sprites"
+                            % (sprite_idx, len(self.sprites)))
+
+    def script(self, sprite_idx, block_idx):
+        """Return script block_idx of sprite sprite_idx."""
+        scripts = self.scripts(sprite_idx)
+        try:
+            return scripts[block_idx]
+        except IndexError:
+            raise Exception("Script %s not found, the sprite has %s scripts"
+                            % (block_idx, len(scripts)))
+
+
+class BlockParser(ContentHandler):
+
+    def __init__(self, code_tags=CODE_TAGS):
         self.name = ''
         self.app = ''
         self.version = ''
+        self.code_tags = code_tags
+        self.skip_depth = 0
         self.stack = []
-        self._custom_blocks = None
+        self.current_tag = None
+        self.text_parts = []
+        # Filled in as the elements are parsed.
+        self.index = ProjectIndex()
+        # The CallGraph of the blocks seen by each sprite.
+        self._call_graphs = {}
         self.children = []
-        self._scripts = []
 
     def pushT(self, tag):
+        """Attach tag to the innermost open element and open it."""
+        if self.text_parts:
+            self.flush_text()
         self.current_tag = tag
-        state, stack = find_closest(self.children, copy.copy(self.stack))
-        self.stack.append(tag.name)
-        if len(self.stack) == 1:
-            self.children.append(self.current_tag)
+        if self.stack:
+            self.stack[LAST].children.append(tag)
         else:
-            state.children.append(self.current_tag)
+            self.children.append(tag)
+        self.stack.append(tag)
         return tag
 
     def popT(self, tag=None):
@@ -783,89 +1513,201 @@ class BlockParser(ContentHandler):
                 name = tag
             else:
                 name = tag.name
-            if issubclass(tag1.__class__, Block):
-                tag1 = 'block'
-            assert name == tag1, "Tag stack mismatch %r != %r" % (tag, tag1)
-        return tag
+            assert name == tag1.name, \
+                "Tag stack mismatch %r != %r" % (tag, tag1)
+        return tag1
+
+    def flush_text(self):
+        """Store the text gathered so far on the current tag."""
+        self.current_tag.text = ''.join(self.text_parts)
+        self.text_parts = []
+
+    def xml_parser(self):
+        """Return an lxml parser that feeds this handler directly.
+
+        The handler acts as the parser target, so the Tag tree is
+        built in a single pass without an intermediate element tree.
+        """
+        return lxml.etree.XMLParser(target=self)
+
+    def skip_tag(self, name):
+        """Return True if the element shouldn't be added to the tree.
+
+        Once an element is skipped all its descendants are skipped
+        too, they are only counted so the matching end can be found.
+        """
+        if self.skip_depth:
+            self.skip_depth += 1
+            return True
+        if self.code_tags is None or not self.stack:
+            return False
+        parent = self.stack[LAST]
+        if parent.name in CONTAINER_TAGS and name not in self.code_tags:
+            self.skip_depth = 1
+            return True
+        return False
 
-    def startElementNS(self, name, qname, attributes):
-        attributes = dict([(attributes.getQNameByName(k), v)
-                           for k, v in attributes.items()])
-        tag = tag_parsers.get(qname, Tag)(name, qname, attributes)
+    # lxml parser target interface
+
+    def start(self, tag, attrib):
+        if self.skip_tag(tag):
+            return
+        attributes = dict([(k, native_str(v)) for k, v in attrib.items()])
+        tag = tag_parsers.get(tag, Tag)((None, tag), tag, attributes)
         self.pushT(tag)
         return tag
 
-    def endElementNS(self, name, qname):
+    def end(self, tag):
+        if self.skip_depth:
+            self.skip_depth -= 1
+            return
+        if self.text_parts:
+            self.flush_text()
         self.current_tag = None
         if self.stack:
-            self.popT(qname)
-
-    def characters(self, data):
-        if not hasattr(self, 'current_tag'):
+            node = self.popT(tag)
+            node.close()
+            if isinstance(node, BlockDefinition):
+                names = self.stack_names()
+                if names == BLOCKS_PATH:
+                    self.index.add_block_definition(node)
+                elif names == SPRITE_BLOCKS_PATH:
+                    self.index.add_sprite_block_definition(node)
+            elif node.name == 'sprite' and self.stack_names() == SPRITE_PATH:
+                self.index.add_sprite(node)
+
+    def stack_names(self):
+        return [t.name for t in self.stack]
+
+    def data(self, data):
+        if self.skip_depth:
             return
         if data and isinstance(self.current_tag, (Option, LiteralBlock)):
-            self.current_tag.children.append(data)
+            self.text_parts.append(native_str(data))
 
-    def scripts(self, ctx):
-        scripts = find_first(self, ['project', 'stage', 'sprites',
-                                    'sprite', 'scripts'])
-        if not scripts:
-            return []
+    def close(self):
+        return self
 
-        if self._scripts:
-            return self._scripts
+    # SAX interface, kept so the handler can still be driven by
+    # lxml.sax.saxify or any other SAX producer.
+
+    def startElementNS(self, name, qname, attributes):
+        if self.skip_tag(qname):
+            return
+        attributes = dict([(attributes.getQNameByName(k), v)
+                           for k, v in attributes.items()])
+        tag = tag_parsers.get(qname, Tag)(name, qname, attributes)
+        self.pushT(tag)
+        return tag
 
-        counter = itertools.count().next
-        args = ast.arguments([], None, None, [])
-        globals = ast.Global(['_globals'])
-        vars = ast.Assign([ast.Name('_globals', ast.Store())],
-                          ast.Dict([], []))
-        self._scripts = []
-        for script in scripts.children:
-            self._scripts.append(
-                ast.FunctionDef('main_' + str(counter()),
-                                args,
-                                [globals, vars] + script.to_ast(ctx),
-                                []))
+    def endElementNS(self, name, qname):
+        self.end(qname)
 
-        return self._scripts
+    def characters(self, data):
+        self.data(data)
+
+    def scripts(self, ctx, entry_point=None, sprite_idx=0):
+        """Return a main_N function for each script of a sprite.
+
+        If entry_point is given only the function for that script is
+        compiled, the other scripts are never looked at.
+        """
+        if entry_point is None:
+            return [self.script_function(ctx, index, script)
+                    for index, script
+                    in enumerate(self.script_elements(sprite_idx))]
+        script = self.index.script(sprite_idx, entry_point)
+        return [self.script_function(ctx, entry_point, script)]
+
+    def script_elements(self, sprite_idx=0):
+        """Return the script elements of sprite sprite_idx."""
+        return self.index.scripts(sprite_idx)
+
+    def script_function(self, ctx, index, script):
+        """Return the main_N function of script.
+
+        Scripts are cached by the fingerprint of their blocks and their
+        index, see compile_unit.
+        """
+        def compile(ctx):
+            ctx.name_counts = {}
+            args = ast.arguments([], None, None, [])
+            globals = ast.Global(['_globals'])
+            vars = ast.Assign([ast.Name('_globals', ast.Store())],
+                              ast.Dict([], []))
+            return ast.FunctionDef('main_' + str(index),
+                                   args,
+                                   [globals, vars] + script.to_ast(ctx),
+                                   [])
+        key = '%s %s' % (script.code_fingerprint(), index)
+        return compile_unit(script_cache, key, ctx, compile)
 
     @property
     def custom_blocks(self):
-        if self._custom_blocks:
-            return self._custom_blocks
-        blocks = find_first(self, ['project', 'blocks'])
-        if not blocks:
-            return {}
-        self._custom_blocks = dict([(block.custom_block_id(), block)
-                                    for block in blocks.children])
-        return self._custom_blocks
-
-    def create_context(self, module=None):
-        return Context(custom_blocks=self.custom_blocks, used_custom_blocks=[])
-
-    def to_ast(self, ctx, main_func=None):
+        """The block definitions global to the project."""
+        return self.index.custom_blocks
+
+    @property
+    def call_graph(self):
+        """The CallGraph of the custom blocks of the project."""
+        if None not in self._call_graphs:
+            self._call_graphs[None] = CallGraph.from_blocks(
+                self.custom_blocks)
+        return self._call_graphs[None]
+
+    def sprite_call_graph(self, sprite_idx):
+        """The CallGraph of the custom blocks seen by a sprite."""
+        blocks = self.index.sprite_custom_blocks(sprite_idx)
+        if blocks is self.custom_blocks:
+            return self.call_graph
+        if sprite_idx not in self._call_graphs:
+            self._call_graphs[sprite_idx] = CallGraph.from_blocks(blocks)
+        return self._call_graphs[sprite_idx]
+
+    def create_context(self, module=None, sprite_idx=0):
+        return Context(
+            custom_blocks=self.index.sprite_custom_blocks(sprite_idx))
+
+    def to_ast(self, ctx, main_func=None, entry_point=None,
+               profile=instrument.NULL_PROFILE, sprite_idx=0):
+        """Return the module for the scripts of sprite sprite_idx.
+
+        If entry_point is given only the main function of that script
+        is compiled, along with the custom blocks it uses directly or
+        through other custom blocks.  The phases of the compilation
+        are measured by profile, see snappy.instrument.
+        """
         script = ast.parse(SCRIPT_HEADER)
         script_footer = ast.parse(SCRIPT_FOOTER)
         body = script.body
-        ctx = self.create_context(module=script)
-        body.extend(self.scripts(ctx))
-
-        # Try and add custom blocks
-        while True:
-            try:
-                block = ctx.used_custom_blocks.pop()
-            except IndexError:
-                break
-            block = self.custom_blocks[block]
-            try:
-                block_ast = block.to_ast(ctx)
-            except Exception:
-                LOG.debug("Failed to generate function for %s"
-                          % block.block_name)
-                raise
+        ctx = self.create_context(module=script, sprite_idx=sprite_idx)
+        custom_blocks = ctx.custom_blocks
+        with profile.phase('scripts'):
+            body.extend(self.scripts(ctx, entry_point, sprite_idx))
+
+        # Add the custom blocks used by the scripts, and the ones they
+        # use in turn, each after the blocks it calls.
+        with profile.phase('call_graph'):
+            if entry_point is None:
+                scripts = self.script_elements(sprite_idx)
             else:
-                body.append(block_ast)
+                scripts = [self.index.script(sprite_idx, entry_point)]
+            calls = set()
+            for element in scripts:
+                calls.update(custom_block_calls(element))
+            graph = self.sprite_call_graph(sprite_idx)
+            emitted = graph.sorted(graph.reachable(calls))
+        with profile.phase('custom_blocks'):
+            for name in emitted:
+                block = custom_blocks[name]
+                try:
+                    block_ast = block.to_ast(ctx)
+                except Exception:
+                    LOG.debug("Failed to generate function for %s"
+                              % block.block_name)
+                    raise
+                else:
+                    body.append(block_ast)
         if main_func:
             body.append(
                 ast.Expr(
@@ -874,18 +1716,17 @@ class BlockParser(ContentHandler):
                         [], [], None, None)))
 
         script.body.extend(script_footer.body)
-        return script
+        with profile.phase('tail_calls'):
+            return trampoline_tail_calls(
+                script, set(custom_blocks[name].function_name
+                            for name in emitted))
 
 
-def parse(filename):
-    tree = lxml.etree.parse(open(filename))
-    handler = BlockParser()
-    lxml.sax.saxify(tree, handler)
-    return handler
+def parse(filename, code_tags=CODE_TAGS):
+    handler = BlockParser(code_tags)
+    return lxml.etree.parse(filename, handler.xml_parser())
 
 
-def parses(string):
-    tree = lxml.etree.parse(StringIO(string))
-    handler = BlockParser()
-    lxml.sax.saxify(tree, handler)
-    return handler
+def parses(string, code_tags=CODE_TAGS):
+    handler = BlockParser(code_tags)
+    return lxml.etree.fromstring(string, handler.xml_parser())
@@ -15,12 +15,159 @@ def doReport(result, name=None):
     return result
 
 
+class TailCall(object):
+    """A call returned by a custom block instead of being made.
+
+    See trampoline.
+    """
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+
+def trampoline(result):
+    """Make the calls returned as TailCalls until a value is returned."""
+    while isinstance(result, TailCall):
+        result = result.function(*result.args)
+    return result
+
+
+class List(object):
+    """A Snap! list.
+
+    Like the lists of Snap! itself a list is either arrayed, with its
+    items in contents, or linked, with its first item in first and the
+    list of the other items in rest.  CONS creates a linked list and
+    the CDR of a linked list is its rest, so both take constant time
+    and lists built by recursive blocks share their tails.  The CDR of
+    an arrayed list is a new linked list, so changing it doesn't
+    change the arrayed one, and walking it takes constant time per
+    item.  Changing a list turns it into an arrayed list.
+    """
+    __slots__ = ('contents', 'first', 'rest', 'is_linked')
+
+    def __init__(self, contents=()):
+        self.contents = list(contents)
+        self.first = None
+        self.rest = None
+        self.is_linked = False
+
+    @classmethod
+    def cons(cls, first, rest):
+        result = cls.__new__(cls)
+        result.contents = None
+        result.first = first
+        result.rest = rest
+        result.is_linked = True
+        return result
+
+    def car(self):
+        if self.is_linked:
+            return self.first
+        return self.contents[0]
+
+    def cdr(self):
+        if self.is_linked:
+            return self.rest
+        rest = List()
+        cons = List.cons
+        for item in reversed(self.contents[1:]):
+            rest = cons(item, rest)
+        return rest
+
+    def become_array(self):
+        if not self.is_linked:
+            return
+        self.contents = list(self)
+        self.first = None
+        self.rest = None
+        self.is_linked = False
+
+    def __iter__(self):
+        node = self
+        while node.is_linked:
+            yield node.first
+            node = node.rest
+        for item in node.contents:
+            yield item
+
+    def __len__(self):
+        length = 0
+        node = self
+        while node.is_linked:
+            length += 1
+            node = node.rest
+        return length + len(node.contents)
+
+    def __nonzero__(self):
+        return self.is_linked or bool(self.contents)
+
+    def __getitem__(self, index):
+        """Return the item at index, or a new arrayed List for a slice.
+
+        Indexing from the start walks the linked items, a slice or a
+        negative index turns the list into an arrayed one first.
+        """
+        if isinstance(index, slice):
+            self.become_array()
+            return List(self.contents[index])
+        if index >= 0:
+            node = self
+            while node.is_linked:
+                if index == 0:
+                    return node.first
+                index -= 1
+                node = node.rest
+            return node.contents[index]
+        self.become_array()
+        return self.contents[index]
+
+    def append(self, item):
+        self.become_array()
+        self.contents.append(item)
+
+    def insert(self, index, item):
+        self.become_array()
+        self.contents.insert(index, item)
+
+    def __eq__(self, other):
+        if isinstance(other, (List, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'List(%r)' % list(self)
+
+
+def as_list(value):
+    """Return value as a List, value can be a List or a Python list."""
+    if isinstance(value, List):
+        return value
+    return List(value)
+
+
+def json_default(value):
+    if isinstance(value, List):
+        return list(value)
+    raise TypeError("%r is not JSON serializable" % value)
+
+
 def dumpReport(script_file):
     import json
     import os
     result_file = os.path.join(os.path.dirname(script_file), 'result.json')
     result = open(result_file, 'w')
-    result.write(json.dumps(_report['result']))
+    result.write(json.dumps(_report['result'], default=json_default))
 
 
 # Builtin Report methods
@@ -37,10 +184,15 @@ def reportNot(a):
     return doReport(not a)
 
 
-def reportEquals(a, b):
+def equals(a, b):
+    """Compare like Snap!, text is compared case insensitively."""
     if isinstance(a, basestring) and isinstance(b, basestring):
-        return doReport(a.lower() == b.lower())
-    return doReport(a == b)
+        return a.lower() == b.lower()
+    return a == b
+
+
+def reportEquals(a, b):
+    return doReport(equals(a, b))
 
 
 def reportAnd(a, b):
@@ -61,19 +213,23 @@ def reportLessThan(a, b):
 
 def reportNewList(a):
     # a list is expected as the first argument
-    return doReport(a)
+    return doReport(List(a))
 
 
 def reportCAR(a):
+    if isinstance(a, List):
+        return doReport(a.car())
     return doReport(a[0])
 
 
 def reportCDR(a):
+    if isinstance(a, List):
+        return doReport(a.cdr())
     return doReport(a[1:])
 
 
 def reportCONS(a, b):
-    return doReport([a] + b)
+    return doReport(List.cons(a, as_list(b)))
 
 
 def reportJoinWords(a):
@@ -3,6 +3,7 @@ import imp
 
 import astor
 
+from snappy import optimizer as snap_optimizer
 from snappy import parser as snap_parser
 from snappy import stdlib as snap_stdlib
 
@@ -47,6 +48,7 @@ class BlockParser():
     script = ""
     report = None
     vars = None
+    optimize = 0
 
     def test_parse(self):
         snap_stdlib.cleanReport()
@@ -59,6 +61,7 @@ class BlockParser():
         parser = snap_parser.parses(document)
         ctx = parser.create_context()
         script = parser.to_ast(ctx)
+        script = snap_optimizer.optimize(script, self.optimize)
         ast.fix_missing_locations(script)
         try:
             code = compile(script, '<string>', 'exec')
@@ -0,0 +1,98 @@
+from os import path
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from snappy import batch
+from snappy import parser
+from snappy.tests import test_parser
+
+
+SAMPLE_PROGRAMS = path.join(path.dirname(__file__), 'sample_programs')
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp('snappy')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.output = path.join(self.directory, 'build')
+        self.broken = path.join(self.directory, 'broken.xml')
+        with open(self.broken, 'w') as file:
+            file.write('<project><stage>')
+
+    def test_find_projects(self):
+        self.assertEqual(
+            batch.find_projects([SAMPLE_PROGRAMS,
+                                 path.join(self.directory, '*.xml')]),
+            [path.join(SAMPLE_PROGRAMS, 'base_blocks.xml'),
+             path.join(SAMPLE_PROGRAMS, 'wh_words.xml'),
+             self.broken])
+
+    def test_compile_project(self):
+        result = batch.compile_project(
+            path.join(SAMPLE_PROGRAMS, 'base_blocks.xml'))
+        self.assertEqual(result['error'], None)
+        self.assertEqual([(s['sprite'], s['index'])
+                          for s in result['scripts']], [(0, 0), (0, 1)])
+        self.assertTrue('def main_1():' in result['scripts'][1]['source'])
+
+    def test_broken_project(self):
+        result = batch.compile_project(self.broken)
+        self.assertTrue(result['error'].startswith('XMLSyntaxError'),
+                        result['error'])
+        self.assertEqual(result['scripts'], [])
+
+    def test_main(self):
+        status = batch.main(['-o', self.output, '-j', '2',
+                             SAMPLE_PROGRAMS, self.broken])
+        self.assertEqual(status, 1)
+        report = json.load(open(path.join(self.output, 'report.json')))
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual([path.basename(project['filename'])
+                          for project in report['projects']],
+                         ['base_blocks.xml', 'wh_words.xml', 'broken.xml'])
+        program = path.join(self.output, 'wh_words', 'sprite_0', 'main_0.py')
+        self.assertEqual(report['projects'][1]['scripts'][0]['program'],
+                         program)
+        self.assertTrue(path.exists(program))
+
+    def test_sprites(self):
+        filename = path.join(self.directory, 'sprites.xml')
+        with open(filename, 'w') as file:
+            file.write(test_parser.TestProjectIndex.xml)
+        result = batch.compile_project(filename)
+        handler = parser.parse(filename)
+        self.assertEqual(
+            [(s['sprite'], s['index']) for s in result['scripts']],
+            [(sprite, index)
+             for sprite, scripts in enumerate(handler.index.sprite_scripts)
+             for index in range(len(scripts))])
+        self.assertTrue(any(s['sprite'] == 1 for s in result['scripts']))
+
+    def test_same_names(self):
+        for name in ('a', 'b'):
+            os.mkdir(path.join(self.directory, name))
+            shutil.copy(path.join(SAMPLE_PROGRAMS, 'wh_words.xml'),
+                        path.join(self.directory, name))
+        projects = [path.join(self.directory, name) for name in ('a', 'b')]
+        # The same project matched twice is compiled once.
+        self.assertEqual(batch.find_projects(projects + projects), [
+            path.join(project, 'wh_words.xml') for project in projects])
+        status = batch.main(['-o', self.output, '-j', '1'] + projects)
+        self.assertEqual(status, 0)
+        report = json.load(open(path.join(self.output, 'report.json')))
+        # Both are compiled, each into its own directory.
+        first, second = report['projects']
+        self.assertEqual([first['output'], second['output']],
+                         [path.join(self.output, 'wh_words'),
+                          path.join(self.output, 'wh_words_2')])
+        for project in (first, second):
+            self.assertEqual(project['error'], None)
+            program = project['scripts'][0]['program']
+            self.assertTrue(program.startswith(project['output']), program)
+            self.assertTrue(path.exists(program))
+        self.assertEqual(batch.output_names(['a/p.xml', 'b/p.xml', 'p_2.xml']),
+                         ['p', 'p_2', 'p_2_2'])
@@ -0,0 +1,91 @@
+import json
+import os
+import tempfile
+import unittest
+
+from snappy import benchmark
+from snappy import compiler
+from snappy import parser
+
+
+class TestSyntheticProject(unittest.TestCase):
+
+    def run_script(self, xml, index=0):
+        namespace = {}
+        exec compiler.compile_code(xml, index) in namespace
+        namespace['main_%s' % index]()
+        return namespace['_globals']['v']
+
+    def test_shape(self):
+        xml = benchmark.synthetic_project(scripts=7, depth=4, blocks=3)
+        handler = parser.parses(xml)
+        self.assertEqual(len(handler.script_elements()), 7)
+        self.assertEqual(len(list(handler.call_graph)), 3)
+        self.assertEqual(xml.count('<block s="doIf">'), 7 * 4)
+
+    def test_calls(self):
+        # bench 0 adds n to bench 1, which adds n to n.
+        xml = benchmark.synthetic_project(scripts=1, blocks=2)
+        self.assertEqual(self.run_script(xml), 9)
+
+    def test_recursive(self):
+        xml = benchmark.synthetic_project(scripts=1, blocks=2,
+                                          recursive=True)
+        self.assertEqual(self.run_script(xml), 0)
+        handler = parser.parses(xml)
+        self.assertEqual(len(handler.call_graph.recursive()), 2)
+
+    def test_no_blocks(self):
+        xml = benchmark.synthetic_project(scripts=3, blocks=0)
+        self.assertEqual(self.run_script(xml, 2), 2)
+
+    def test_media(self):
+        xml = benchmark.synthetic_project(media=10000)
+        self.assertTrue(len(xml) > 10000)
+        handler = parser.parses(xml)
+        self.assertEqual(benchmark.count_tags(handler),
+                         benchmark.count_tags(parser.parses(
+                             benchmark.synthetic_project())))
+
+
+class TestSuite(unittest.TestCase):
+
+    def test_run(self):
+        projects = [('small', benchmark.synthetic_project(scripts=2))]
+        results = benchmark.run_suite(projects, number=1, repeat=1)
+        result = results['small']
+        self.assertEqual(result['scripts'], 2)
+        for key in benchmark.COMPARED:
+            self.assertTrue(result[key] >= 0, key)
+        self.assertTrue(result['parse_mb_s'] > 0)
+
+    def test_compare(self):
+        baseline = {'a': {'parse': 1.0, 'compile': 1.0, 'peak': 10000},
+                    'b': {'parse': 1.0}}
+        results = {'a': {'parse': 1.05, 'compile': 2.0, 'peak': 10500},
+                   'c': {'parse': 5.0}}
+        self.assertEqual(benchmark.compare(results, baseline),
+                         [('a', 'compile', 1.0, 2.0)])
+        self.assertEqual(benchmark.compare(results, baseline, 1.5), [])
+        results['a']['peak'] = 30000
+        self.assertEqual(benchmark.compare(results, baseline, 1.5),
+                         [('a', 'peak', 10000, 30000)])
+
+    def test_main(self):
+        fd, filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        small = [('small', dict(scripts=1, blocks=1))]
+        original = benchmark.SUITE
+        benchmark.SUITE = small
+        self.addCleanup(setattr, benchmark, 'SUITE', original)
+        self.assertEqual(benchmark.main(['-n', '1', '-r', '1',
+                                         '--save', filename]), 0)
+        with open(filename) as file:
+            baseline = json.load(file)
+        self.assertTrue('small' in baseline)
+        baseline['small']['parse'] = 0
+        with open(filename, 'w') as file:
+            json.dump(baseline, file)
+        self.assertEqual(benchmark.main(['-n', '1', '-r', '1',
+                                         '--compare', filename]), 1)
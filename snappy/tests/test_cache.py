@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os import path
+
+from snappy import cache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_bounded(self):
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertFalse('b' in lru)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+        self.assertEqual(lru.get('b', 'missing'), 'missing')
+
+
+class TestProgramCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = path.join(tempfile.mkdtemp('snappy'), '.cache')
+        self.addCleanup(shutil.rmtree, path.dirname(self.directory))
+
+    def test_program_key(self):
+        key = cache.program_key('<project/>', 0)
+        self.assertEqual(key, cache.program_key('<project/>', 0))
+        self.assertNotEqual(key, cache.program_key('<project/>', 1))
+        self.assertNotEqual(key, cache.program_key('<project/>', 0,
+                                                   sprite_idx=1))
+        self.assertNotEqual(key, cache.program_key('<project />', 0))
+
+    def test_program_version(self):
+        key = cache.program_key('<project/>', 0)
+        version = cache.PROGRAM_VERSION
+        self.addCleanup(setattr, cache, 'PROGRAM_VERSION', version)
+        cache.PROGRAM_VERSION = version + 1
+        self.assertNotEqual(key, cache.program_key('<project/>', 0))
+
+    def test_memory_and_disk(self):
+        programs = cache.ProgramCache(self.directory, size=1)
+        self.assertEqual(programs.get('a'), None)
+        programs.set('a', 'print 1')
+        programs.set('b', 'print 2')
+        self.assertEqual(programs.get('b'), 'print 2')
+        # 'a' was pushed out of memory and is read back from disk.
+        self.assertEqual(programs.get('a'), 'print 1')
+        self.assertEqual(programs.stats(),
+                         {'hits': 2, 'disk_hits': 1, 'misses': 1, 'size': 1})
+
+        # A new cache, like after a restart, finds the stored programs.
+        programs = cache.ProgramCache(self.directory)
+        self.assertEqual(programs.get('b'), 'print 2')
+        self.assertEqual(programs.disk_hits, 1)
+
+    def test_disk_bounded(self):
+        programs = cache.ProgramCache(self.directory, size=1, disk_size=2)
+        programs.set('a', 'print 1')
+        programs.set('b', 'print 2')
+        os.utime(programs.path('a'), (1, 1))
+        os.utime(programs.path('b'), (2, 2))
+        # Reading 'a' from disk makes it the most recently used.
+        self.assertEqual(programs.get('a'), 'print 1')
+        programs.set('c', 'print 3')
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['a.pyc', 'c.pyc'])
+        self.assertEqual(cache.ProgramCache(self.directory).get('b'), None)
@@ -0,0 +1,72 @@
+from os import path
+import imp
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from snappy import compiler
+from snappy import parser
+from snappy import stdlib
+from snappy.tests import test_parser
+
+
+SAMPLE_PROGRAMS = path.join(path.dirname(__file__), 'sample_programs')
+
+WH_WORDS = open(path.join(SAMPLE_PROGRAMS, 'wh_words.xml')).read()
+
+
+class TestCompileCode(unittest.TestCase):
+
+    def test_compile_code(self):
+        stdlib.cleanReport()
+        code = compiler.compile_code(WH_WORDS, 0)
+        module = imp.new_module('compiled_program')
+        exec code in module.__dict__
+        self.assertEqual(stdlib._report['result'],
+                         ['whoever', 'Who', 'What.', 'What'])
+
+    def test_sprite(self):
+        code = compiler.compile_code(test_parser.TestProjectIndex.xml, 0,
+                                     sprite_idx=1)
+        namespace = {}
+        exec code in namespace
+        namespace['main_0']()
+        self.assertEqual(namespace['_globals'], {'v': 'second'})
+
+    def test_same_as_source(self):
+        source = compiler.compile_program(WH_WORDS, 0)
+        code = compiler.compile_code(WH_WORDS, 0)
+        self.assertEqual(code.co_names,
+                         compile(source, 'job.py', 'exec').co_names)
+
+    def test_threads(self):
+        parser.clear_caches()
+        self.addCleanup(parser.clear_caches)
+        expected = compiler.compile_program(WH_WORDS, 0)
+        sources = []
+
+        def compile_program():
+            for i in range(5):
+                parser.clear_caches()
+                sources.append(compiler.compile_program(WH_WORDS, 0))
+        threads = [threading.Thread(target=compile_program)
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sources, [expected] * 20)
+
+    def test_dump_pyc(self):
+        job_dir = tempfile.mkdtemp('snappy')
+        self.addCleanup(shutil.rmtree, job_dir)
+        program = path.join(job_dir, 'job.pyc')
+        with open(program, 'wb') as file:
+            file.write(compiler.dump_pyc(compiler.compile_code(WH_WORDS, 0)))
+        subprocess.check_call([sys.executable, program])
+        result = json.load(open(path.join(job_dir, 'result.json')))
+        self.assertEqual(result, ['whoever', 'Who', 'What.', 'What'])
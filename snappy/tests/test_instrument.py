@@ -0,0 +1,64 @@
+import time
+import unittest
+
+from snappy import compiler
+from snappy import instrument
+from snappy.tests import test_compiler
+
+
+class TestProfile(unittest.TestCase):
+
+    def fake(self, module, name, values):
+        """Replace name in module with a function returning values."""
+        values = iter(values)
+        self.addCleanup(setattr, module, name, getattr(module, name))
+        setattr(module, name, lambda: next(values))
+
+    def test_phases(self):
+        self.fake(instrument.time, 'time',
+                  [10.0, 10.5, 20.0, 21.0, 21.25, 23.0])
+        self.fake(instrument, 'resident_memory',
+                  [100, 400, 1000, 1000, 1200, 900])
+        profile = instrument.Profile()
+        with profile.phase('a'):
+            pass
+        with profile.phase('b'):
+            with profile.phase('a'):
+                pass
+        self.assertEqual(profile.as_list(), [
+            {'phase': 'a', 'time': 0.75, 'rss': 500, 'count': 2},
+            {'phase': 'b', 'time': 3.0, 'rss': -100, 'count': 1}])
+
+    def test_no_proc(self):
+        self.fake(instrument, 'resident_memory', [None, None])
+        profile = instrument.Profile()
+        with profile.phase('a'):
+            pass
+        self.assertEqual(profile.as_list()[0]['rss'], None)
+
+    def test_rss(self):
+        if instrument.resident_memory() is None:
+            self.skipTest('/proc/self/statm is not available')
+        size = 64 * 1024 * 1024
+        profile = instrument.Profile()
+        with profile.phase('allocate'):
+            start = time.time()
+            data = 'x' * size
+            time.sleep(0.05)
+            elapsed = time.time() - start
+        phase = profile.as_list()[0]
+        self.assertTrue(phase['rss'] >= size / 2, phase)
+        self.assertTrue(elapsed <= phase['time'] < elapsed + 0.05, phase)
+        del data
+
+    def test_compile(self):
+        profile = instrument.Profile()
+        compiler.compile_code(test_compiler.WH_WORDS, 0, profile=profile)
+        self.assertEqual([phase['phase'] for phase in profile.as_list()],
+                         ['parse', 'scripts', 'call_graph', 'custom_blocks',
+                          'tail_calls', 'optimize', 'bytecode'])
+
+    def test_null_profile(self):
+        with instrument.NULL_PROFILE.phase('a'):
+            pass
+        self.assertEqual(instrument.NULL_PROFILE.as_list(), [])
@@ -0,0 +1,141 @@
+import ast
+import unittest
+
+import astor
+
+from snappy import compiler
+from snappy import optimizer
+from snappy import parser
+from snappy import tests
+from snappy.tests import test_parser
+
+
+class TestOptimizer(unittest.TestCase):
+
+    def assertOptimized(self, source, expected, level=2):
+        module = ast.parse(source)
+        before = ast.dump(module)
+        result = optimizer.optimize(module, level)
+        self.assertEqual(astor.to_source(result).strip(), expected)
+        # The original module is never modified.
+        self.assertEqual(ast.dump(module), before)
+
+    def test_level_0(self):
+        self.assertOptimized('stdlib.reportSum(1, 2)',
+                             'stdlib.reportSum(1, 2)', level=0)
+
+    def test_fold(self):
+        self.assertOptimized('stdlib.reportSum(1, 2)',
+                             'stdlib.doReport(3)', level=1)
+        self.assertOptimized('stdlib.reportSum(1, stdlib.reportSum(2, 3))',
+                             'stdlib.doReport(6)', level=1)
+        self.assertOptimized('stdlib.reportNot(stdlib.reportTrue())',
+                             'stdlib.doReport(False)', level=1)
+        self.assertOptimized("stdlib.reportEquals('A', 'a')",
+                             'stdlib.doReport(True)', level=1)
+        self.assertOptimized("stdlib.reportStringSize('four')",
+                             'stdlib.doReport(4)', level=1)
+
+    def test_fold_error(self):
+        self.assertOptimized("stdlib.reportSum(1, 'a')",
+                             "stdlib.reportSum(1, 'a')")
+
+    def test_fold_observable_report(self):
+        self.assertOptimized('if stdlib.reportLessThan(1, 2):\n    pass',
+                             'if stdlib.doReport(True):\n    pass')
+
+    def test_lower(self):
+        self.assertOptimized('stdlib.doReport(stdlib.reportSum(a, b))',
+                             'stdlib.doReport((a + b))')
+        self.assertOptimized('stdlib.reportSum(a, b)',
+                             'stdlib.reportSum(a, b)')
+        self.assertOptimized(
+            'return stdlib.doReport(stdlib.reportNot('
+            'stdlib.reportGreaterThan(a, b)))',
+            'return stdlib.doReport((not (a > b)))')
+        self.assertOptimized(
+            'f(stdlib.reportLessThan(a, 1))',
+            'f(stdlib.reportLessThan(a, 1))')
+
+    def test_lower_only_at_level_2(self):
+        self.assertOptimized('stdlib.doReport(stdlib.reportSum(a, b))',
+                             'stdlib.doReport(stdlib.reportSum(a, b))',
+                             level=1)
+
+    def test_lower_equals(self):
+        self.assertOptimized('stdlib.doReport(stdlib.reportEquals(a, 1))',
+                             'stdlib.doReport((a == 1))')
+        self.assertOptimized("stdlib.doReport(stdlib.reportEquals(a, 'x'))",
+                             "stdlib.doReport(stdlib.reportEquals(a, 'x'))")
+
+    def test_lower_bool(self):
+        self.assertOptimized('stdlib.doReport(stdlib.reportAnd(a, b))',
+                             'stdlib.doReport((a and b))')
+        self.assertOptimized('stdlib.doReport(stdlib.reportOr(a, f()))',
+                             'stdlib.doReport(stdlib.reportOr(a, f()))')
+        # Reading an item can raise, so it is always evaluated.
+        self.assertOptimized(
+            "stdlib.doReport(stdlib.reportAnd(a, _globals['b']))",
+            "stdlib.doReport(stdlib.reportAnd(a, _globals['b']))")
+        self.assertOptimized('stdlib.doReport(stdlib.reportOr(a, b.c))',
+                             'stdlib.doReport(stdlib.reportOr(a, b.c))')
+        # A script variable in a local may not be set yet.
+        self.assertOptimized(
+            'stdlib.doReport(stdlib.reportAnd(a, _v_b))',
+            'stdlib.doReport(stdlib.reportAnd(a, _v_b))')
+
+
+class TestWHWordsOptimized(test_parser.TestWHWordsFunction):
+    optimize = 2
+
+
+class TestReverseBlockOptimized(test_parser.TestReverseBlock):
+    optimize = 2
+
+
+class TestAllButTheLastLetterOptimized(test_parser.TestAllButTheLastLetter):
+    optimize = 2
+
+
+class TestdoForEachOptimized(test_parser.TestdoForEach):
+    optimize = 2
+
+
+class TestreportAndOptimized(test_parser.TestreportAnd):
+    optimize = 2
+
+
+class TestFastLocalsOptimized(unittest.TestCase):
+
+    block = """
+    <block-definition s="both %'a'" type="predicate" category="operators">
+      <inputs><input type="%b"/></inputs>
+      <script>
+        <block s="doDeclareVariables"><list><l>b</l></list></block>
+        <block s="doIf">
+          <block var="a"/>
+          <script><block s="doSetVar"><l>b</l><l>true</l></block></script>
+        </block>
+        <block s="doReport">
+          <block s="reportAnd"><block var="a"/><block var="b"/></block>
+        </block>
+      </script>
+    </block-definition>
+    """
+
+    script = """
+    <custom-block s="both %b"><block s="reportFalse"/></custom-block>
+    """
+
+    def test_unset_local(self):
+        document = tests.BlockParser.xml.format(script=self.script,
+                                                block=self.block)
+        handler = parser.parses(document)
+        # b is only set when a is true, reading it raises at every level.
+        for level in (0, 2):
+            code = compiler.compile_script_code(handler, 0, level)
+            self.assertRaises(UnboundLocalError, self.run_code, code)
+
+    def run_code(self, code):
+        # The compiled program runs its script when it's executed.
+        exec code in {}
@@ -1,8 +1,15 @@
 from os import path
+import ast
+import collections
 import unittest
 
+import astor
+
 from snappy import tests
+from snappy import benchmark
+from snappy import compiler
 from snappy import parser
+from snappy import stdlib
 
 
 SAMPLE_PROGRAMS = path.join(path.dirname(__file__), 'sample_programs')
@@ -350,6 +357,41 @@ class TestdoIfPass(tests.BlockParser, unittest.TestCase):
     vars = {'test': 'true'}
 
 
+class TestEvaluate(tests.BlockParser, unittest.TestCase):
+
+    script = """
+    <block s="doSetVar"><l>add</l>
+      <block s="reifyReporter">
+        <autolambda>
+          <block s="reportSum"><block var="a"/><block var="b"/></block>
+        </autolambda>
+        <list><l>a</l><l>b</l></list>
+      </block>
+    </block>
+    <block s="doSetVar"><l>x</l>
+      <block s="evaluate"><block var="add"/><list><l>1</l><l>2</l></list>
+      </block>
+    </block>
+    <block s="doSetVar"><l>inputs</l>
+      <block s="reportNewList"><list><block var="x"/><l>4</l></list></block>
+    </block>
+    <block s="doSetVar"><l>y</l>
+      <block s="evaluate"><block var="add"/><block var="inputs"/></block>
+    </block>
+    """
+
+    report = {'result': 7}
+
+    def test_calls(self):
+        document = self.xml.format(script=self.script, block=self.block)
+        handler = parser.parses(document)
+        source = astor.to_source(handler.to_ast(handler.create_context()))
+        self.assertTrue("_globals['add'](1, 2)" in source, source)
+        self.assertTrue("_globals['add'](*_globals['inputs'])" in source,
+                        source)
+        self.assertFalse('eval_' in source, source)
+
+
 class TestdoForEach(tests.BlockParser, unittest.TestCase):
     parser = parser.doForEach
 
@@ -437,6 +479,260 @@ class TestBlockDefinition(tests.BlockParser, unittest.TestCase):
         self.assertEqual(block.function_arguments, ['data'])
 
 
+class TestFastLocals(tests.BlockParser, unittest.TestCase):
+
+    block = """
+    <block-definition s="count to %'n'" type="reporter" category="other">
+      <inputs><input type="%n"/></inputs>
+      <script>
+        <block s="doDeclareVariables">
+          <list><l>i</l><l>total</l><l>ring</l><l>my var</l></list>
+        </block>
+        <block s="doSetVar"><l>i</l><l>0</l></block>
+        <block s="doSetVar"><l>total</l><l>0</l></block>
+        <block s="doSetVar"><l>my var</l><l>0</l></block>
+        <block s="doSetVar"><l>ring</l>
+          <block s="reifyReporter">
+            <autolambda><block var="total"/></autolambda>
+            <list/>
+          </block>
+        </block>
+        <block s="doUntil">
+          <block s="reportGreaterThan"><block var="i"/><block var="n"/></block>
+          <script>
+            <block s="doChangeVar"><l>i</l><l>1</l></block>
+            <block s="doChangeVar"><l>total</l><block var="i"/></block>
+          </script>
+        </block>
+        <block s="doReport">
+          <block s="evaluate"><block var="ring"/><list/></block>
+        </block>
+      </script>
+    </block-definition>
+    """
+
+    script = """
+    <custom-block s="count to %n"><l>3</l></custom-block>
+    """
+
+    report = {'result': 10}
+
+    def test_locals(self):
+        document = self.xml.format(script=self.script, block=self.block)
+        handler = parser.parses(document)
+        source = astor.to_source(handler.to_ast(handler.create_context()))
+        self.assertTrue("_v_i = (_v_i + 1)" in source, source)
+        self.assertTrue("_v_ring = reify_" in source, source)
+        # Used by the ring, so it has to be shared with it.
+        self.assertTrue("_locals['total'] = 0" in source, source)
+        # Not a valid Python identifier.
+        self.assertTrue("_locals['my var'] = 0" in source, source)
+
+
+TAIL_CALL_BLOCK = """
+<block-definition s="{name} %'n'" type="reporter" category="other">
+  <inputs><input type="%n"/></inputs>
+  <script>
+    <block s="doIfElse">
+      <block s="reportEquals"><block var="n"/><l>0</l></block>
+      <script><block s="doReport"><l>{result}</l></block></script>
+      <script>
+        <block s="doReport">
+          <custom-block s="{callee} %n">
+            <block s="reportSum"><block var="n"/><l>-1</l></block>
+          </custom-block>
+        </block>
+      </script>
+    </block>
+  </script>
+</block-definition>
+"""
+
+
+class TestTailCalls(tests.BlockParser, unittest.TestCase):
+
+    blocks = [
+        TAIL_CALL_BLOCK.format(name='count down', callee='count down',
+                               result='done'),
+        TAIL_CALL_BLOCK.format(name='even?', callee='odd?', result='true'),
+        TAIL_CALL_BLOCK.format(name='odd?', callee='even?', result='false'),
+    ]
+
+    # Both are deeper than the recursion limit.
+    script = """
+    <block s="doSetVar"><l>a</l>
+      <custom-block s="count down %n"><l>3000</l></custom-block>
+    </block>
+    <block s="doSetVar"><l>b</l>
+      <custom-block s="even? %n"><l>3001</l></custom-block>
+    </block>
+    """
+
+    vars = {'a': 'done', 'b': 'false'}
+
+    def test_source(self):
+        document = self.xml.format(script=self.script,
+                                   block=''.join(self.blocks))
+        handler = parser.parses(document)
+        source = astor.to_source(handler.to_ast(handler.create_context()))
+        self.assertTrue('(n,) = (stdlib.reportSum(n, (-1)),)' in source,
+                        source)
+        self.assertTrue('return stdlib.TailCall(odd_n_, ' in source, source)
+        self.assertTrue('return stdlib.TailCall(even_n_, ' in source,
+                        source)
+        self.assertTrue("stdlib.trampoline(even_n_(3001))" in source, source)
+        self.assertFalse("trampoline(count_down_n_" in source, source)
+
+
+FALL_THROUGH_BLOCK = """
+<block-definition s="{name} %'n'" type="reporter" category="other">
+  <inputs><input type="%n"/></inputs>
+  <script>
+    <block s="doIf">
+      <block s="reportLessThan"><l>0</l><block var="n"/></block>
+      <script>
+        <block s="doReport">
+          <custom-block s="{callee} %n">
+            <block s="reportSum"><block var="n"/><l>-1</l></block>
+          </custom-block>
+        </block>
+      </script>
+    </block>
+  </script>
+</block-definition>
+"""
+
+
+class TestFallThroughTailCalls(tests.BlockParser, unittest.TestCase):
+
+    blocks = [
+        FALL_THROUGH_BLOCK.format(name='count down', callee='count down'),
+        FALL_THROUGH_BLOCK.format(name='ping', callee='pong'),
+        FALL_THROUGH_BLOCK.format(name='pong', callee='ping'),
+    ]
+
+    # The last block to report is the call reaching 0, which falls
+    # through, not the comparison before it.
+    script = """
+    <custom-block s="count down %n"><l>3</l></custom-block>
+    <custom-block s="ping %n"><l>3</l></custom-block>
+    """
+
+    report = {'result': None}
+
+    def test_source(self):
+        document = self.xml.format(script=self.script,
+                                   block=''.join(self.blocks))
+        handler = parser.parses(document)
+        source = astor.to_source(handler.to_ast(handler.create_context()))
+        self.assertFalse('while True' in source, source)
+        self.assertFalse('TailCall' in source, source)
+        self.assertTrue('return stdlib.doReport(pong_n_(' in source, source)
+
+
+class TestScope(unittest.TestCase):
+
+    def test_extend(self):
+        outer = parser.EMPTY_SCOPE.extend(['a'])
+        inner = outer.extend(['b', 'c'])
+        self.assertTrue('a' in inner)
+        self.assertTrue('c' in inner)
+        self.assertFalse('b' in outer)
+        self.assertTrue(outer.extend([]) is outer)
+
+    def test_context_copy(self):
+        ctx = parser.Context(inherited_scope=parser.EMPTY_SCOPE.extend('a'))
+        ctx1 = ctx.copy()
+        self.assertTrue(ctx1.inherited_scope is ctx.inherited_scope)
+        ctx1.inherited_scope = ctx1.inherited_scope.extend(['b'])
+        self.assertTrue(ctx1.is_argument('a'))
+        self.assertTrue(ctx1.is_argument('b'))
+        self.assertFalse(ctx.is_argument('b'))
+
+
+class TestSignature(unittest.TestCase):
+
+    def test_signature(self):
+        handler = parser.parse(path.join(SAMPLE_PROGRAMS, 'base_blocks.xml'))
+        block = handler.custom_blocks['map %repRing over %mult%l']
+        self.assertEqual(block.signature, parser.Signature(
+            name="map %'function' over %'lists'",
+            function_name='map_function_over_lists_',
+            arguments=('function', 'lists'),
+            argument_types=('%repRing', '%mult%l'),
+            block_id='map %repRing over %mult%l',
+            local_variables=frozenset(['mapone', 'mapmany'])))
+        self.assertTrue(block.signature is block.signature)
+
+    def test_custom_blocks(self):
+        document = tests.BlockParser.xml.format(
+            script='', block=TestDefinitionCache.block.format(arg='x'))
+        # Blocks defined by a sprite aren't project blocks.
+        document = document.replace(
+            '<blocks/>', '<blocks>%s</blocks>' % TAIL_CALL_BLOCK.format(
+                name='sprite', callee='sprite', result=''))
+        handler = parser.parses(document)
+        self.assertEqual(sorted(handler.custom_blocks),
+                         ['join %s', 'twice %s'])
+        self.assertEqual(sorted(handler.index.sprite_custom_blocks(0)),
+                         ['join %s', 'sprite %n', 'twice %s'])
+
+
+class TestCallGraph(unittest.TestCase):
+
+    def setUp(self):
+        handler = parser.parse(path.join(SAMPLE_PROGRAMS, 'base_blocks.xml'))
+        self.graph = handler.call_graph
+
+    def test_calls(self):
+        self.assertEqual(self.graph.callees('sort %l ordering with %predRing'),
+                         ('sort %l ordering with %predRing',))
+        self.assertEqual(
+            self.graph.callees('list->sentence %l'),
+            ('combine with %repRing items of %l', 'join words %mult%txt'))
+        self.assertTrue('keep items such that %predRing from %l'
+                        in self.graph.callers('empty? %l'))
+        # Calls to blocks the project doesn't define are left out.
+        self.assertEqual(
+            self.graph.callees('remove duplicates from %l'),
+            ('remove duplicates from %l',))
+
+    def test_reachable(self):
+        self.assertEqual(self.graph.reachable(['list->sentence %l']),
+                         set(['list->sentence %l',
+                              'combine with %repRing items of %l',
+                              'join words %mult%txt',
+                              'empty? %l']))
+        self.assertEqual(self.graph.reachable(['unknown']), set())
+
+    def test_recursive(self):
+        recursive = self.graph.recursive()
+        self.assertTrue('append %mult%l' in recursive)
+        self.assertFalse('empty? %l' in recursive)
+
+    def test_components(self):
+        graph = parser.CallGraph(collections.OrderedDict([
+            ('a', ['b']), ('b', ['c', 'a']), ('c', []), ('d', ['a'])]))
+        self.assertEqual(graph.components(), [('c',), ('a', 'b'), ('d',)])
+        self.assertEqual(graph.recursive(), frozenset(['a', 'b']))
+        self.assertEqual(graph.sorted(['d', 'c', 'a']), ['c', 'a', 'd'])
+
+    def test_long_chain(self):
+        names = ['b%s' % i for i in range(5000)]
+        graph = parser.CallGraph(collections.OrderedDict(
+            (name, names[i + 1:i + 2]) for i, name in enumerate(names)))
+        self.assertEqual(graph.sorted(names), list(reversed(names)))
+
+    def test_emission_order(self):
+        handler = parser.parses(tests.BlockParser.xml.format(
+            script=TestDefinitionCache.script,
+            block=TestDefinitionCache.block.format(arg='x')))
+        module = handler.to_ast(handler.create_context())
+        self.assertEqual([node.name for node in module.body
+                          if isinstance(node, ast.FunctionDef)],
+                         ['main_0', 'join_x_', 'twice_data_'])
+
+
 class TestArgumentParser(unittest.TestCase):
     pass
 
@@ -475,3 +771,566 @@ class TestAllButTheLastLetter(tests.BlockParser, unittest.TestCase):
     """
 
     report = {'result': 'Who picks up the ball and throws it to What'}
+
+
+def tag_tree(node):
+    """Return a comparable representation of a parsed Tag tree."""
+    return (node.__class__, node.name, node.attributes, node.text,
+            [tag_tree(child) for child in node.children
+             if isinstance(child, parser.Tag)])
+
+
+class TestSinglePassParser(unittest.TestCase):
+
+    def assertSameTree(self, filename):
+        xml = open(path.join(SAMPLE_PROGRAMS, filename)).read()
+        expected = benchmark.saxify_parses(xml)
+        handler = parser.parses(xml)
+        self.assertEqual([tag_tree(c) for c in handler.children],
+                         [tag_tree(c) for c in expected.children])
+        self.assertEqual(handler.stack, [])
+
+    def test_wh_words(self):
+        self.assertSameTree('wh_words.xml')
+
+    def test_base_blocks(self):
+        self.assertSameTree('base_blocks.xml')
+
+    def test_parse_file(self):
+        filename = path.join(SAMPLE_PROGRAMS, 'wh_words.xml')
+        expected = parser.parses(open(filename).read())
+        handler = parser.parse(filename)
+        self.assertEqual([tag_tree(c) for c in handler.children],
+                         [tag_tree(c) for c in expected.children])
+
+
+class TestMediaSkipping(unittest.TestCase):
+
+    xml = """
+<project name="media" app="Snap! 4.0, http://snap.berkeley.edu" version="1">
+  <thumbnail>data:image/png;base64,iVBORw0KGgo=</thumbnail>
+  <stage name="Stage" width="480" height="360">
+    <pentrails>data:image/png;base64,iVBORw0KGgo=</pentrails>
+    <costumes><list><item><costume name="c" image="data:,"/></item></list>
+    </costumes>
+    <sprites>
+      <sprite name="Graph" idx="1">
+        <costumes><list><item><l>data:image/png;base64,</l></item></list>
+        </costumes>
+        <sounds><list><item><sound sound="data:audio/wav;base64,"/></item>
+        </list></sounds>
+        <scripts>
+          <script><block s="doReport"><l>done</l></block></script>
+        </scripts>
+      </sprite>
+    </sprites>
+  </stage>
+  <media><costume name="c" image="data:,"/></media>
+  <blocks/>
+</project>
+"""
+
+    def names(self, handler):
+        return [c.name for c in handler.children[0].children]
+
+    def test_skip_media(self):
+        handler = parser.parses(self.xml)
+        self.assertEqual(self.names(handler), ['stage', 'blocks'])
+        stage = handler.children[0].children[0]
+        self.assertEqual([c.name for c in stage.children], ['sprites'])
+        sprite = parser.find_first(handler, ['project', 'stage', 'sprites',
+                                             'sprite'])
+        self.assertEqual([c.name for c in sprite.children], ['scripts'])
+        self.assertEqual(handler.stack, [])
+        self.assertEqual(handler.skip_depth, 0)
+
+    def test_keep_everything(self):
+        handler = parser.parses(self.xml, code_tags=None)
+        self.assertEqual(self.names(handler),
+                         ['thumbnail', 'stage', 'media', 'blocks'])
+
+    def test_custom_code_tags(self):
+        code_tags = parser.CODE_TAGS | set(['media'])
+        handler = parser.parses(self.xml, code_tags=code_tags)
+        self.assertEqual(self.names(handler), ['stage', 'media', 'blocks'])
+
+    def test_scripts_still_compile(self):
+        handler = parser.parses(self.xml)
+        ctx = handler.create_context()
+        self.assertEqual(len(handler.scripts(ctx)), 1)
+
+
+class TestProjectIndex(unittest.TestCase):
+
+    xml = """
+<project name="sprites" app="Snap! 4.0, http://snap.berkeley.edu" version="1">
+  <stage name="Stage">
+    <sprites>
+      <sprite name="First">
+        <scripts>
+          <script><block s="doSetVar"><l>v</l><l>first</l></block></script>
+        </scripts>
+      </sprite>
+      <sprite name="Second">
+        <costumes><list/></costumes>
+        <scripts>
+          <script><block s="doSetVar"><l>v</l><l>second</l></block></script>
+          <script>
+            <block s="doSetVar"><l>v</l><custom-block s="double"/></block>
+          </script>
+        </scripts>
+      </sprite>
+      <sprite name="Empty"/>
+    </sprites>
+  </stage>
+  <blocks>
+    <block-definition s="double" type="reporter" category="other">
+      <script>
+        <block s="doReport">
+          <block s="reportSum"><l>1</l><l>1</l></block>
+        </block>
+      </script>
+    </block-definition>
+  </blocks>
+</project>
+"""
+
+    def test_index(self):
+        index = parser.parses(self.xml).index
+        self.assertEqual([sprite.attributes['name']
+                          for sprite in index.sprites],
+                         ['First', 'Second', 'Empty'])
+        self.assertEqual([len(index.scripts(i)) for i in range(3)],
+                         [1, 2, 0])
+        self.assertEqual(index.custom_blocks.keys(), ['double'])
+        script = index.script(1, 0)
+        self.assertEqual(script.children[0].children[1].text, 'second')
+
+    def test_not_found(self):
+        index = parser.parses(self.xml).index
+        self.assertRaisesRegexp(Exception, 'Sprite 3 not found',
+                                index.scripts, 3)
+        self.assertRaisesRegexp(Exception, 'Script 1 not found',
+                                index.script, 0, 1)
+
+    def test_no_sprites(self):
+        handler = parser.parses('<project><blocks/></project>')
+        self.assertEqual(handler.script_elements(), [])
+
+    def test_entry_point(self):
+        handler = parser.parses(self.xml)
+        module = handler.to_ast(handler.create_context(), 'main_1',
+                                entry_point=1, sprite_idx=1)
+        source = astor.to_source(module)
+        self.assertTrue('def main_1():' in source, source)
+        self.assertTrue('def double():' in source, source)
+        self.assertFalse('def main_0():' in source, source)
+
+
+class TestSpriteBlocks(unittest.TestCase):
+
+    # Each sprite reports the result of its own 'double' block, the
+    # third sprite has none and sees the project's block.
+    xml = """
+<project name="sprites" app="Snap! 4.0, http://snap.berkeley.edu" version="1">
+  <stage name="Stage">
+    <sprites>
+      <sprite name="First">
+        <blocks>{first}</blocks>
+        <scripts>
+          <script><block s="doReport"><custom-block s="double"/></block>
+          </script>
+        </scripts>
+      </sprite>
+      <sprite name="Second">
+        <blocks>{second}</blocks>
+        <scripts>
+          <script><block s="doReport"><custom-block s="double"/></block>
+          </script>
+        </scripts>
+      </sprite>
+      <sprite name="Third">
+        <scripts>
+          <script><block s="doReport"><custom-block s="double"/></block>
+          </script>
+        </scripts>
+      </sprite>
+    </sprites>
+  </stage>
+  <blocks>{project}</blocks>
+</project>
+"""
+
+    block = """
+    <block-definition s="double" type="reporter" category="other">
+      <script><block s="doReport"><l>{result}</l></block></script>
+    </block-definition>
+    """
+
+    def setUp(self):
+        parser.clear_caches()
+        self.addCleanup(parser.clear_caches)
+        self.handler = parser.parses(self.xml.format(
+            first=self.block.format(result='first'),
+            second=self.block.format(result='second'),
+            project=self.block.format(result='project')))
+
+    def test_index(self):
+        index = self.handler.index
+        self.assertEqual(index.custom_blocks.keys(), ['double'])
+        self.assertEqual([len(blocks) for blocks in index.sprite_blocks],
+                         [1, 1, 0])
+        self.assertTrue(index.sprite_custom_blocks(2) is index.custom_blocks)
+
+    def test_run(self):
+        for sprite, result in enumerate(['first', 'second', 'project']):
+            stdlib.cleanReport()
+            code = compiler.compile_script_code(self.handler, 0,
+                                                sprite_idx=sprite)
+            namespace = {}
+            exec code in namespace
+            namespace['main_0']()
+            self.assertEqual(stdlib._report['result'], result)
+
+
+class TestDeepNesting(unittest.TestCase):
+
+    def test_deep_nesting(self):
+        depth = 100
+        handler = parser.parses(benchmark.deep_project(depth))
+        script = parser.find_first(handler, ['project', 'stage', 'sprites',
+                                             'sprite', 'scripts', 'script'])
+        for level in range(depth):
+            block = script.children[0]
+            self.assertTrue(isinstance(block, parser.doIf), block)
+            self.assertEqual([c.name for c in block.children],
+                             ['block', 'script'])
+            script = block.children[1]
+        self.assertTrue(isinstance(script.children[0], parser.doSetVar))
+        self.assertEqual(handler.stack, [])
+
+
+class TestCompactNodes(unittest.TestCase):
+
+    def node_classes(self):
+        return [cls for cls in vars(parser).values()
+                if isinstance(cls, type) and issubclass(cls, parser.Tag)]
+
+    def test_no_instance_dict(self):
+        attributes = {'s': 'foo', 'var': 'foo', 'type': 'reporter',
+                      'category': 'other'}
+        for cls in self.node_classes():
+            node = cls(None, 'block', attributes)
+            self.assertFalse(hasattr(node, '__dict__'), cls)
+
+    def test_text(self):
+        handler = parser.parses(
+            '<script><l>one <option>two</option></l><l>th&amp;ree</l>'
+            '<l>caf\xc3\xa9</l></script>')
+        one, three, cafe = handler.children[0].children
+        self.assertEqual(one.text, 'one ')
+        self.assertEqual(one.children[0].text, 'two')
+        self.assertEqual(three.text, 'th&ree')
+        self.assertEqual(cafe.text, u'caf\xe9')
+        self.assertEqual(handler.children[0].text, '')
+
+
+class TestDefinitionCache(unittest.TestCase):
+
+    block = """
+    <block-definition s="twice %'data'" type="reporter" category="other">
+      <inputs><input type="%s"/></inputs>
+      <script>
+        <block s="doReport">
+          <custom-block s="join %s">
+            <block var="data"/>
+          </custom-block>
+        </block>
+      </script>
+    </block-definition>
+    <block-definition s="join %'{arg}'" type="reporter" category="other">
+      <inputs><input type="%s"/></inputs>
+      <script>
+        <block s="doReport">
+          <block s="reportJoinWords">
+            <list><block var="{arg}"/><block var="{arg}"/></list>
+          </block>
+        </block>
+      </script>
+    </block-definition>
+    """
+
+    script = """
+    <custom-block s="twice %s"><l>a</l></custom-block>
+    """
+
+    def setUp(self):
+        parser.clear_caches()
+        self.addCleanup(parser.clear_caches)
+
+    def compile(self, document):
+        handler = parser.parses(document)
+        return astor.to_source(handler.to_ast(handler.create_context(),
+                                              'main_0'))
+
+    def document(self, arg='data'):
+        return tests.BlockParser.xml.format(
+            script=self.script, block=self.block.format(arg=arg))
+
+    def test_reuse(self):
+        source = self.compile(self.document())
+        self.assertEqual(parser.definition_cache.misses, 2)
+        self.assertEqual(parser.definition_cache.hits, 0)
+        self.assertEqual(self.compile(self.document()), source)
+        self.assertEqual(parser.definition_cache.hits, 2)
+
+    def test_reuse_across_projects(self):
+        filename = path.join(SAMPLE_PROGRAMS, 'wh_words.xml')
+        handler = parser.parse(filename)
+        handler.to_ast(handler.create_context())
+        misses = parser.definition_cache.misses
+        block = handler.custom_blocks['sentence->list %txt']
+
+        other = parser.parses(self.document())
+        ctx = other.create_context()
+        ctx.custom_blocks = dict(handler.custom_blocks)
+        ctx.custom_blocks.update(other.custom_blocks)
+        self.assertTrue(block.to_ast(ctx) is not None)
+        self.assertEqual(parser.definition_cache.misses, misses)
+
+    def test_callee_signature_changed(self):
+        self.compile(self.document())
+        # 'twice' is unchanged, but the block it calls renamed its
+        # argument, so it has to be compiled again.
+        source = self.compile(self.document(arg='words'))
+        self.assertTrue('join_words_(data)' in source, source)
+
+    def test_callee_locals_changed(self):
+        self.compile(self.document())
+        document = self.document().replace(
+            '<block s="reportJoinWords">',
+            '<block s="reportJoinWords"><block s="doDeclareVariables">'
+            '<list><l>z</l></list></block>', 1)
+        handler = parser.parses(document)
+        self.assertEqual(handler.custom_blocks['join %s'].local_variables,
+                         frozenset(['z']))
+        self.compile(document)
+        # 'twice' is compiled again, the locals of the block it calls
+        # are part of its signature.
+        twice = handler.custom_blocks['twice %s']
+        _, signatures = parser.definition_cache.get(parser.fingerprint(twice))
+        self.assertEqual(signatures['join %s'].local_variables,
+                         frozenset(['z']))
+
+
+class TestScriptCache(unittest.TestCase):
+
+    join = """
+    <custom-block s="join %s"><l>a</l></custom-block>
+    """
+
+    def setUp(self):
+        parser.clear_caches()
+        self.addCleanup(parser.clear_caches)
+
+    def document(self, script, arg='data', x='20'):
+        document = tests.BlockParser.xml.format(
+            script=script, block=TestDefinitionCache.block.format(arg=arg))
+        return document.replace('x="20"', 'x="%s"' % x)
+
+    def main(self, document):
+        handler = parser.parses(document)
+        module = handler.to_ast(handler.create_context(), 'main_0')
+        return [node for node in module.body
+                if isinstance(node, ast.FunctionDef)
+                and node.name == 'main_0'][0]
+
+    def test_reuse(self):
+        main = self.main(self.document(TestDefinitionCache.script))
+        self.assertEqual(parser.script_cache.misses, 1)
+        # Moving the script around the editor doesn't change its code.
+        moved = self.main(self.document(TestDefinitionCache.script, x='50'))
+        self.assertTrue(moved is main)
+        self.assertEqual(parser.script_cache.hits, 1)
+
+    def test_script_changed(self):
+        main = self.main(self.document(TestDefinitionCache.script))
+        self.assertFalse(self.main(self.document(self.join)) is main)
+        self.assertEqual(parser.script_cache.misses, 2)
+        # The block definitions didn't change.
+        self.assertEqual(parser.definition_cache.hits, 1)
+
+    def test_callee_signature_changed(self):
+        main = self.main(self.document(self.join))
+        self.assertTrue(self.main(self.document(self.join)) is main)
+        # The script is unchanged, but the block it calls renamed its
+        # argument, so it has to be compiled again.
+        self.assertFalse(
+            self.main(self.document(self.join, arg='words')) is main)
+
+    def test_same_as_full_compile(self):
+        def compile(document):
+            handler = parser.parses(document)
+            return astor.to_source(handler.to_ast(handler.create_context()))
+        filename = path.join(SAMPLE_PROGRAMS, 'wh_words.xml')
+        document = open(filename).read()
+        changed = document.replace('triple play', 'double play')
+        self.assertNotEqual(changed, document)
+        compile(document)
+        incremental = compile(changed)
+        self.assertTrue(parser.script_cache.hits > 0)
+        parser.clear_caches()
+        self.assertEqual(incremental, compile(changed))
+
+
+# A block declaring x that runs a C-slot, and a block passing it a
+# C-slot that sets x.
+WITH_X_BLOCK = """
+<block-definition s="with x %'action'" type="command" category="other">
+  <inputs><input type="%cs"/></inputs>
+  <script>
+    <block s="doDeclareVariables"><list><l>x</l></list></block>
+    <block s="doSetVar"><l>x</l><l>1</l></block>
+    <block s="doRun"><block var="action"/><list/></block>
+  </script>
+</block-definition>
+"""
+
+SET_X_BLOCK = """
+<block-definition s="set x" type="command" category="other">
+  <script>
+    <block s="doDeclareVariables"><list><l>y</l></list></block>
+    <custom-block s="with x %cs">
+      <script><block s="doSetVar"><l>x</l><l>2</l></block></script>
+    </custom-block>
+  </script>
+</block-definition>
+"""
+
+
+class TestCSlotVariables(tests.BlockParser, unittest.TestCase):
+    """A C-slot sees the variables of its caller, not of the callee."""
+
+    blocks = [WITH_X_BLOCK, SET_X_BLOCK]
+
+    script = """
+    <custom-block s="set x"></custom-block>
+    """
+
+    vars = {'x': 2}
+
+
+class TestCSlotCallerVariables(tests.BlockParser, unittest.TestCase):
+
+    blocks = [WITH_X_BLOCK, """
+    <block-definition s="get x" type="reporter" category="other">
+      <script>
+        <block s="doDeclareVariables"><list><l>x</l></list></block>
+        <custom-block s="with x %cs">
+          <script><block s="doSetVar"><l>x</l><l>3</l></block></script>
+        </custom-block>
+        <block s="doReport"><block var="x"/></block>
+      </script>
+    </block-definition>
+    """]
+
+    script = """
+    <block s="doSetVar"><l>result</l>
+      <custom-block s="get x"></custom-block>
+    </block>
+    """
+
+    vars = {'result': 3}
+
+
+class TestWarmCompile(unittest.TestCase):
+
+    def setUp(self):
+        parser.clear_caches()
+        self.addCleanup(parser.clear_caches)
+
+    def compile(self, script, block):
+        handler = parser.parses(tests.BlockParser.xml.format(
+            script=script, block=block))
+        return astor.to_source(handler.to_ast(handler.create_context()))
+
+    def test_same_as_cold_compile(self):
+        script = '<custom-block s="set x"></custom-block>'
+        block = WITH_X_BLOCK + SET_X_BLOCK
+        self.compile('<custom-block s="with x %cs"><script/></custom-block>',
+                     WITH_X_BLOCK)
+        warm = self.compile(script, block)
+        self.assertTrue(parser.definition_cache.hits > 0)
+        parser.clear_caches()
+        self.assertEqual(warm, self.compile(script, block))
+
+    def test_declared_at_parse_time(self):
+        handler = parser.parses(tests.BlockParser.xml.format(
+            script='', block=WITH_X_BLOCK))
+        block = handler.custom_blocks['with x %cs']
+        self.assertEqual(block.signature.local_variables, frozenset(['x']))
+        self.assertTrue(block.is_local_variable('x'))
+
+
+class TestDeterministicNames(unittest.TestCase):
+
+    def compile(self, filename):
+        handler = parser.parse(path.join(SAMPLE_PROGRAMS, filename))
+        return astor.to_source(handler.to_ast(handler.create_context()))
+
+    def test_same_source(self):
+        parser.clear_caches()
+        self.addCleanup(parser.clear_caches)
+        source = self.compile('wh_words.xml')
+        self.assertTrue('def custom_block_0(' in source, source)
+        self.compile('wh_words.xml')
+        parser.clear_caches()
+        self.assertEqual(self.compile('wh_words.xml'), source)
+
+
+class TestEntryPoint(unittest.TestCase):
+
+    block = """
+    <block-definition s="a" type="command" category="other">
+      <inputs/>
+      <script><block s="doSetVar"><l>a</l><l>1</l></block></script>
+    </block-definition>
+    <block-definition s="b" type="command" category="other">
+      <inputs/>
+      <script><custom-block s="c"/></script>
+    </block-definition>
+    <block-definition s="c" type="command" category="other">
+      <inputs/>
+      <script><block s="doSetVar"><l>c</l><l>1</l></block></script>
+    </block-definition>
+    """
+
+    script = """
+    <custom-block s="a"/>
+          </script>
+          <script>
+    <custom-block s="b"/>
+    """
+
+    def function_names(self, module):
+        return [node.name for node in module.body
+                if isinstance(node, ast.FunctionDef)]
+
+    def setUp(self):
+        self.handler = parser.parses(tests.BlockParser.xml.format(
+            script=self.script, block=self.block))
+
+    def test_all_scripts(self):
+        module = self.handler.to_ast(self.handler.create_context())
+        self.assertEqual(sorted(self.function_names(module)),
+                         ['a', 'b', 'c', 'main_0', 'main_1'])
+
+    def test_entry_point(self):
+        module = self.handler.to_ast(self.handler.create_context(),
+                                     'main_1', entry_point=1)
+        self.assertEqual(sorted(self.function_names(module)),
+                         ['b', 'c', 'main_1'])
+
+    def test_missing_entry_point(self):
+        self.assertRaises(Exception, self.handler.to_ast,
+                          self.handler.create_context(), entry_point=2)
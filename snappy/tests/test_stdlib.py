@@ -0,0 +1,82 @@
+import json
+import unittest
+
+from snappy import stdlib
+
+
+class TestList(unittest.TestCase):
+
+    def setUp(self):
+        stdlib.cleanReport()
+
+    def test_cons(self):
+        data = stdlib.reportCONS(1, stdlib.reportCONS(2, []))
+        self.assertTrue(data.is_linked)
+        self.assertEqual(data, [1, 2])
+        self.assertEqual(len(data), 2)
+        self.assertEqual(stdlib._report['result'], [1, 2])
+
+    def test_cdr_shares_structure(self):
+        data = stdlib.reportCONS(1, stdlib.reportNewList([2, 3]))
+        rest = stdlib.reportCDR(data)
+        self.assertTrue(stdlib.reportCDR(data) is rest)
+        self.assertEqual(rest, [2, 3])
+        self.assertEqual(stdlib.reportCAR(rest), 2)
+
+    def test_cdr_of_arrayed_list(self):
+        data = stdlib.reportNewList([1, 2, 3])
+        rest = stdlib.reportCDR(data)
+        self.assertFalse(data.is_linked)
+        self.assertTrue(rest.is_linked)
+        self.assertEqual(rest, [2, 3])
+        self.assertTrue(stdlib.reportCDR(rest) is rest.rest)
+        self.assertEqual(stdlib.reportCDR(stdlib.reportNewList([1])), [])
+        self.assertEqual(stdlib.reportCDR(stdlib.reportNewList([])), [])
+
+    def test_cdr_not_aliased(self):
+        data = stdlib.reportNewList([1, 2, 3])
+        rest = stdlib.reportCDR(data)
+        rest.append(4)
+        self.assertEqual(rest, [2, 3, 4])
+        self.assertEqual(data, [1, 2, 3])
+        data.append(5)
+        self.assertEqual(rest, [2, 3, 4])
+
+    def test_item(self):
+        data = stdlib.reportCONS(1, stdlib.reportNewList([2, 3]))
+        self.assertEqual([stdlib.reportListItem(i, data) for i in (1, 2, 3)],
+                         [1, 2, 3])
+        self.assertEqual(data[-1], 3)
+        self.assertRaises(IndexError, stdlib.reportListItem, 4, data)
+
+    def test_change(self):
+        rest = stdlib.reportNewList([2])
+        data = stdlib.reportCONS(1, rest)
+        data.append(3)
+        data.insert(0, 0)
+        self.assertFalse(data.is_linked)
+        self.assertEqual(data, [0, 1, 2, 3])
+        self.assertEqual(rest, [2])
+
+    def test_long_list(self):
+        data = stdlib.reportNewList(range(10000))
+        while data:
+            data = stdlib.reportCDR(data)
+        self.assertEqual(data, [])
+
+    def test_json(self):
+        data = stdlib.reportCONS('a', stdlib.reportNewList(
+            ['b', stdlib.reportNewList([1])]))
+        self.assertEqual(json.dumps(data, default=stdlib.json_default),
+                         json.dumps(['a', 'b', [1]]))
+
+
+class TestTrampoline(unittest.TestCase):
+
+    def test_trampoline(self):
+        def count(n):
+            if n == 0:
+                return 'done'
+            return stdlib.TailCall(count, n - 1)
+        self.assertEqual(stdlib.trampoline(count(10000)), 'done')
+        self.assertEqual(stdlib.trampoline(1), 1)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from os import path
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from snappy import client
+from snappy import upload
+
+
+SAMPLE_PROGRAMS = path.join(path.dirname(__file__), 'sample_programs')
+
+WH_WORDS = open(path.join(SAMPLE_PROGRAMS, 'wh_words.xml')).read()
+
+PROJECT = (u'<project name="caf\xe9 \U0001f600">\\ "/" \t\n' + u'x' * 100 +
+           u'\u20ac</project>')
+
+
+def feed(decoder, body, size):
+    pieces = []
+    for start in range(0, len(body), size):
+        pieces.extend(decoder.feed(body[start:start + size]))
+    return ''.join(pieces)
+
+
+class TestJSONProjectDecoder(unittest.TestCase):
+
+    fields = {'sprite_idx': 1, 'block_idx': 2, 'other': {'project': 'no'}}
+
+    def body(self, ensure_ascii=True):
+        fields = dict(self.fields, project=PROJECT)
+        body = json.dumps(fields, ensure_ascii=ensure_ascii)
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return body
+
+    def test_split_anywhere(self):
+        # Escapes, surrogate pairs and UTF-8 characters split between
+        # pieces of the body are decoded whole.
+        for ensure_ascii in (True, False):
+            body = self.body(ensure_ascii)
+            for size in (1, 2, 3, 5, 7, 13, len(body)):
+                decoder = upload.JSONProjectDecoder()
+                self.assertEqual(feed(decoder, body, size),
+                                 PROJECT.encode('utf-8'))
+                self.assertEqual(decoder.close(), self.fields)
+
+    def test_no_project(self):
+        for body in ('{"project": 1}', '{"other": {"project": "a"}}',
+                     '["project", "a"]'):
+            decoder = upload.JSONProjectDecoder()
+            feed(decoder, body, 4)
+            self.assertRaises(ValueError, decoder.close)
+
+    def test_unterminated(self):
+        decoder = upload.JSONProjectDecoder()
+        feed(decoder, '{"project": "<project', 4)
+        self.assertRaises(ValueError, decoder.close)
+
+    def test_invalid_escape(self):
+        decoder = upload.JSONProjectDecoder()
+        self.assertRaises(ValueError, decoder.feed,
+                          '{"project": "\\x<project></project>"}')
+
+
+class TestProjectUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp('snappy')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_upload(self):
+        body = json.dumps({'block_idx': 0, 'project': WH_WORDS})
+        project = upload.ProjectUpload(self.directory)
+        for start in range(0, len(body), 1000):
+            project.feed(body[start:start + 1000])
+        self.assertEqual(project.close(), {'block_idx': 0})
+        self.assertEqual(project.digest.hexdigest(),
+                         hashlib.sha1(WH_WORDS).hexdigest())
+        self.assertEqual(open(project.filename).read(), WH_WORDS)
+        phases = [phase['phase'] for phase in project.profile.as_list()]
+        # The project isn't parsed while it's read.
+        self.assertEqual(phases, ['decode', 'write_xml'])
+
+    def test_error(self):
+        body = json.dumps({'block_idx': 0, 'project': '<project><stage>'})
+        project = upload.ProjectUpload(self.directory)
+        project.feed(body[:-5])
+        self.assertRaises(Exception, project.close)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def feed(self, body, encoding=None, size=1000):
+        project = upload.ProjectUpload(self.directory, encoding)
+        for start in range(0, len(body), size):
+            project.feed(body[start:start + size])
+        return project
+
+    def test_xml(self):
+        project = self.feed('\n' + WH_WORDS)
+        self.assertEqual(project.close(), {})
+        self.assertEqual(project.digest.hexdigest(),
+                         hashlib.sha1(WH_WORDS).hexdigest())
+        self.assertEqual(open(project.filename).read(), WH_WORDS)
+
+    def test_compressed(self):
+        json_body = json.dumps({'block_idx': 1, 'project': WH_WORDS})
+        for body, fields in ((WH_WORDS, {}), (json_body, {'block_idx': 1})):
+            for encoding in ('gzip', 'deflate'):
+                project = self.feed(client.compress(body, encoding),
+                                    encoding, size=100)
+                self.assertEqual(project.close(), fields)
+                self.assertEqual(open(project.filename).read(), WH_WORDS)
+                self.assertTrue('decompress' in project.profile.phases)
+
+    def test_unsupported_encoding(self):
+        project = self.feed(WH_WORDS, 'br')
+        self.assertRaises(ValueError, project.close)
+
+    def test_empty(self):
+        project = self.feed('  ')
+        self.assertRaises(ValueError, project.close)
+
+    def test_too_large(self):
+        bomb = '<project>' + ' ' * (10 * 1024 * 1024) + '</project>'
+        for body, encoding in ((bomb, 'gzip'), (bomb, 'deflate'),
+                               (WH_WORDS, None)):
+            if encoding:
+                body = client.compress(body, encoding)
+            project = upload.ProjectUpload(self.directory, encoding,
+                                           max_size=len(WH_WORDS) - 1)
+            project.feed(body)
+            # No more than one byte past the limit is decompressed.
+            self.assertTrue(project.size <= len(WH_WORDS), project.size)
+            self.assertRaises(upload.ProjectTooLarge, project.close)
+            self.assertEqual(os.listdir(self.directory), [])
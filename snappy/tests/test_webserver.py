@@ -2,14 +2,19 @@ from StringIO import StringIO
 from datetime import datetime
 from os import path
 import json
+import os
 import shutil
 import tempfile
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import gatherResults, succeed
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial import unittest
+from twisted.web.server import NOT_DONE_YET
 from twisted.web.test.test_web import DummyRequest
 
+from snappy import client
 from snappy import webserver
+from snappy.tests import test_parser
 
 
 SAMPLE_PROGRAMS = path.join(path.dirname(__file__), 'sample_programs')
@@ -28,6 +33,7 @@ class TestJobsHandler(unittest.TestCase):
         self.jobs_dir = tempfile.mkdtemp('snappy')
         self.service = webserver.SnapServer(self.jobs_dir)
         self.addCleanup(self.deleteJobDir)
+        self.addCleanup(self.service.stopCompilePool)
 
     def deleteJobDir(self):
         shutil.rmtree(self.jobs_dir)
@@ -40,6 +46,26 @@ class TestJobsHandler(unittest.TestCase):
         self.assertTrue('jobs' in res, res)
         self.assertEqual(res['jobs']['running'], 0, res)
         self.assertEqual(res['jobs']['completed'], 0, res)
+        self.assertEqual(res['cache']['hits'], 0, res)
+        self.assertEqual(res['cache']['misses'], 0, res)
+
+    def render_post(self, handler, request):
+        # The upload is read on the compile pool, the response follows.
+        self.assertEqual(handler.render_POST(request), NOT_DONE_YET)
+        d = request.notifyFinish()
+        d.addCallback(lambda _: json.loads(''.join(request.written)))
+        return d
+
+    def post(self, handler, project=None, **fields):
+        request = DummyRequest([''])
+        if project is None:
+            project = open(program_path('wh_words.xml')).read()
+        body = {'sprite_idx': 0, 'block_idx': 0, 'project': project}
+        body.update(fields)
+        request.content = StringIO(json.dumps(body))
+        d = self.render_post(handler, request)
+        d.addCallback(lambda res: handler.children[res['id']])
+        return d
 
     def testPOST(self):
         handler = webserver.JobsHandler(self.service)
@@ -49,33 +75,31 @@ class TestJobsHandler(unittest.TestCase):
              'block_idx': 0,
              'project': open(program_path('wh_words.xml')).read()}))
 
-        # Start a job
-        json_res = handler.render_POST(request)
-        res = json.loads(json_res)
-        self.assertTrue(res['id'], res)
-
-        # Check job handler has the correct job_id
-        job_handler = handler.children[res['id']]
-        self.assertEqual(res['id'], job_handler.id)
-        self.assertEqual(job_handler.state, 'running')
+        def _check_job(res):
+            self.assertTrue(res['id'], res)
 
-        # Check job process handler has the correct job_id
-        job_process = job_handler.job_process
-        self.assertEqual(res['id'], job_process.id)
+            # Check job handler has the correct job_id, it's compiled in
+            # the background
+            job_handler = handler.children[res['id']]
+            self.assertEqual(res['id'], job_handler.id)
+            self.assertEqual(job_handler.state, 'compiling')
+            self.assertEqual(job_handler.state_dict()['started'], None)
+            self.assertEqual(self.service.job_ids(), [res['id']])
+            d = job_handler.wait_for()
+            d.addCallback(_check_response, job_handler)
+            return d
 
-        # Check state dict
-        state = job_handler.state_dict()
-        self.assertEqual(state['finished'], None)
-        self.assertTrue(isinstance(parse_date(state['started']), datetime),
-                        state['started'])
-        self.assertEqual(state['id'], res['id'])
-        self.assertEqual(state['state'], 'running')
+        def _check_response(result, job_handler):
+            # Check job process handler has the correct job_id
+            self.assertEqual(job_handler.id, job_handler.job_process.id)
 
-        request = DummyRequest([''])
-        d = Deferred()
+            # Only the bytecode is written, the source is a debug artifact
+            self.assertTrue(path.exists(path.join(job_handler.job_dir,
+                                                  'job.pyc')))
+            self.assertFalse(path.exists(path.join(job_handler.job_dir,
+                                                   'job.py')))
 
-        def _check_response(data):
-            data = job_handler.render_GET(request)
+            data = job_handler.render_GET(DummyRequest(['']))
             state = json.loads(data)
             self.assertTrue(isinstance(parse_date(state['finished']),
                                        datetime),
@@ -83,12 +107,273 @@ class TestJobsHandler(unittest.TestCase):
             self.assertTrue(isinstance(parse_date(state['started']),
                                        datetime),
                             state['started'])
-            self.assertEqual(state['id'], res['id'])
+            self.assertEqual(state['id'], job_handler.id)
             self.assertEqual(state['state'], 'finished')
             self.assertEqual(state['result'],
                              ["whoever", "Who", "What.", "What"])
+            phases = [phase['phase'] for phase in state['profile']]
+            for phase in ['parse', 'scripts', 'custom_blocks', 'bytecode',
+                          'write_pyc']:
+                self.assertTrue(phase in phases, phases)
+            # The profile is kept with the state of the finished job.
+            job = webserver.JobHandler(handler, self.service, job_handler.id)
+            self.assertEqual(job.state_dict()['profile'],
+                             job_handler.profile)
+
+        d = self.render_post(handler, request)
+        d.addCallback(_check_job)
+        return d
+
+    def testGETWhileCompiling(self):
+        handler = webserver.JobsHandler(self.service)
+        request = DummyRequest([''])
+
+        def _get(job_handler):
+            self.assertEqual(job_handler.render_GET(request), NOT_DONE_YET)
+            return job_handler.wait_for()
+
+        def _check_response(result):
+            state = json.loads(''.join(request.written))
+            self.assertEqual(state['state'], 'finished')
+            self.assertEqual(request.finished, 1)
+
+        d = self.post(handler)
+        d.addCallback(_get)
+        d.addCallback(_check_response)
+        return d
+
+    def assertJobError(self, handler, project, message, **fields):
+        def _wait(job_handler):
+            d = job_handler.wait_for()
+            d.addCallback(_check_state, job_handler)
+            return d
+
+        def _check_state(result, job_handler):
+            state = job_handler.state_dict()
+            self.assertEqual(state['state'], 'error')
+            self.assertEqual(state['started'], None)
+            log = open(job_handler.log_file).read()
+            self.assertTrue(message in log, log)
+            job = webserver.JobHandler(handler, self.service, job_handler.id)
+            self.assertEqual(job.state, 'error')
+            self.flushLoggedErrors(Exception)
+
+        d = self.post(handler, project, **fields)
+        d.addCallback(_wait)
+        return d
+
+    def testCompileError(self):
+        handler = webserver.JobsHandler(self.service)
+        script = test_parser.TestProjectIndex.xml.replace(
+            '<custom-block s="double"/>', '<custom-block s="missing"/>')
+        return self.assertJobError(handler, script,
+                                   "Block 'missing' not found",
+                                   sprite_idx=1, block_idx=1)
+
+    def testParseError(self):
+        # The project is only parsed when it's compiled.
+        handler = webserver.JobsHandler(self.service)
+        return self.assertJobError(handler, '<project><stage>',
+                                   'XMLSyntaxError')
+
+    def testSpawnError(self):
+        def spawnProcess(*args, **kwargs):
+            raise OSError('No such file or directory')
+        self.patch(webserver.reactor, 'spawnProcess', spawnProcess)
+        handler = webserver.JobsHandler(self.service)
+        return self.assertJobError(handler, None, 'No such file or directory')
+
+    def assertBadRequest(self, body, code=400, encoding=None, **args):
+        handler = webserver.JobsHandler(self.service)
+        request = DummyRequest([''])
+        request.args = args
+        if encoding:
+            request.requestHeaders.setRawHeaders('content-encoding',
+                                                 [encoding])
+        request.content = StringIO(body)
+
+        def _check_response(res):
+            self.assertEqual(request.responseCode, code)
+            self.assertTrue(res['error'], res)
+            self.assertEqual(handler.children, {})
+            self.assertEqual(self.service.job_ids(), [])
+            # The upload isn't left behind.
+            self.assertEqual(os.listdir(self.service.upload_dir), [])
+            return res['error']
+
+        d = self.render_post(handler, request)
+        d.addCallback(_check_response)
+        return d
+
+    def assertBadRequests(self, *bodies):
+        # One at a time, each checks that its upload is discarded.
+        d = succeed(None)
+        for body in bodies:
+            d.addCallback(lambda _, body=body: self.assertBadRequest(body))
+        return d
+
+    def testPOSTBadBody(self):
+        return self.assertBadRequests(
+            '{"block_idx": 0, "project": "<project', '<project><stage>', '')
+
+    def testPOSTTooLarge(self):
+        self.service.max_project_size = 1000
+        bomb = '<project>' + ' ' * (1024 * 1024) + '</project>'
+        return self.assertBadRequest(client.compress(bomb, 'gzip'), 413,
+                                     'gzip', block_idx=['0'])
+
+    def testPOSTNoBlockIdx(self):
+        project = open(program_path('wh_words.xml')).read()
+
+        def _check_error(error):
+            self.assertTrue('block_idx' in error, error)
+
+        d = self.assertBadRequest(json.dumps({'project': project}))
+        d.addCallback(_check_error)
+        d.addCallback(lambda _: self.assertBadRequests(project))
+        d.addCallback(lambda _: self.assertBadRequest(project,
+                                                      block_idx=['first']))
+        return d
+
+    def testPOSTNegativeIdx(self):
+        project = open(program_path('wh_words.xml')).read()
+
+        def _check_error(error):
+            self.assertTrue('negative sprite_idx' in error, error)
+
+        d = self.assertBadRequest(project, block_idx=['-1'])
+        d.addCallback(lambda _: self.assertBadRequest(
+            project, sprite_idx=['-1'], block_idx=['0']))
+        d.addCallback(_check_error)
+        return d
+
+    def testPOSTCached(self):
+        handler = webserver.JobsHandler(self.service)
+        job_handlers = []
+
+        def _wait(job_handler):
+            job_handlers.append(job_handler)
+            return job_handler.wait_for()
+
+        def _post_again(result):
+            d = self.post(handler)
+            d.addCallback(_wait)
+            return d
+
+        def _check_results(result):
+            for job_handler in job_handlers:
+                state = job_handler.state_dict()
+                self.assertEqual(state['state'], 'finished')
+                self.assertEqual(state['result'],
+                                 ["whoever", "Who", "What.", "What"])
+            # A cached program isn't parsed again.
+            phases = [[phase['phase'] for phase in job_handler.profile]
+                      for job_handler in job_handlers]
+            self.assertTrue('parse' in phases[0], phases)
+            self.assertFalse('parse' in phases[1], phases)
+            stats = self.service.program_cache.stats()
+            self.assertEqual(stats['misses'], 1, stats)
+            self.assertEqual(stats['hits'], 1, stats)
+            request = DummyRequest([''])
+            res = json.loads(handler.render_GET(request))
+            self.assertEqual(res['jobs']['completed'], 2, res)
+
+        d = self.post(handler)
+        d.addCallback(_wait)
+        d.addCallback(_post_again)
+        d.addCallback(_check_results)
+        return d
+
+    def testPOSTConcurrent(self):
+        handler = webserver.JobsHandler(self.service)
+
+        def _wait(job_handlers):
+            d = gatherResults([job_handler.wait_for()
+                               for job_handler in job_handlers])
+            d.addCallback(_check_results, job_handlers)
+            return d
+
+        def _check_results(result, job_handlers):
+            for job_handler in job_handlers:
+                self.assertEqual(job_handler.state_dict()['result'],
+                                 ["whoever", "Who", "What.", "What"])
+
+        d = gatherResults([self.post(handler), self.post(handler)])
+        d.addCallback(_wait)
+        return d
+
+    def testPOSTDebug(self):
+        self.service.debug = True
+        handler = webserver.JobsHandler(self.service)
+
+        def _wait(job_handler):
+            d = job_handler.wait_for()
+            d.addCallback(_check_source, job_handler)
+            return d
+
+        def _check_source(result, job_handler):
+            source = open(path.join(job_handler.job_dir, 'job.py')).read()
+            self.assertTrue('def main_0():' in source, source)
+
+        d = self.post(handler)
+        d.addCallback(_wait)
+        return d
+
+    def testPOSTXML(self):
+        handler = webserver.JobsHandler(self.service)
+        request = DummyRequest([''])
+        request.args = {'sprite_idx': ['1'], 'block_idx': ['1']}
+        request.requestHeaders.setRawHeaders('content-encoding', ['gzip'])
+        request.content = StringIO(client.compress(
+            test_parser.TestProjectIndex.xml, 'gzip'))
+
+        def _wait(res):
+            job_handler = handler.children[res['id']]
+            d = job_handler.wait_for()
+            d.addCallback(_check_result, job_handler)
+            return d
+
+        def _check_result(result, job_handler):
+            state = job_handler.state_dict()
+            self.assertEqual(state['state'], 'finished')
+            self.assertEqual(state['result'], 2)
+            phases = [phase['phase'] for phase in state['profile']]
+            self.assertTrue('decompress' in phases, phases)
+
+        d = self.render_post(handler, request)
+        d.addCallback(_wait)
+        return d
+
+    def testPOSTSite(self):
+        site = self.service.getSite()
+        requests = []
+
+        def request_factory(*args, **kwargs):
+            requests.append(site.__class__.requestFactory(*args, **kwargs))
+            return requests[-1]
+        site.requestFactory = request_factory
+        channel = site.buildProtocol(None)
+        transport = StringTransport()
+        channel.makeConnection(transport)
+        body = json.dumps(
+            {'sprite_idx': 0,
+             'block_idx': 0,
+             'project': open(program_path('wh_words.xml')).read()})
+        channel.dataReceived('POST /jobs HTTP/1.0\r\n'
+                             'Content-Length: %d\r\n\r\n' % len(body))
+        for start in range(0, len(body), 1000):
+            channel.dataReceived(body[start:start + 1000])
+
+        # The job is only created once the upload has been read.
+        self.assertEqual(transport.value(), '')
+
+        def _check_response(result):
+            response = transport.value().split('\r\n\r\n', 1)[1]
+            id = json.loads(response)['id']
+            jobs = site.resource.children['jobs']
+            self.assertEqual(self.service.job_ids(), [id])
+            return jobs.children[id].wait_for()
 
-        d1 = job_process.wait_for()
-        d1.addCallback(_check_response)
-        d1.chainDeferred(d)
+        d = requests[-1].notifyFinish()
+        d.addCallback(_check_response)
         return d
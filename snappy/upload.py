@@ -0,0 +1,284 @@
+"""Read the project of a job from the request body.
+
+The body of POST /jobs is either the project XML or a JSON object
+holding the project XML in a string, and may be compressed with gzip
+or deflate.  The body is decompressed and decoded piece by piece as it
+is fed, and every piece of XML is hashed and written to a file, so the
+body is never held in memory as a whole.  The project isn't parsed
+here, the job parses the file only when its program isn't cached.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import zlib
+
+from snappy import instrument
+
+
+# The member of the body holding the project XML.
+PROJECT_KEY = 'project'
+
+# A run of complete characters and escapes of a JSON string.  A high
+# surrogate is only complete along with what follows it, so surrogate
+# pairs are never split between pieces.
+STRING_PART = re.compile(r'''
+(?: [^"\\]+
+  | \\["\\/bfnrt]
+  | \\u(?![dD][89abAB])[0-9a-fA-F]{4}
+  | \\u[dD][89abAB][0-9a-fA-F]{2}(?:\\u[0-9a-fA-F]{4}|(?=[^\\]|\\[^u]))
+)*''', re.VERBOSE)
+
+# The length of the longest incomplete escape, a high surrogate
+# waiting for the escape after it.
+MAX_ESCAPE = 12
+
+WHITESPACE = ' \t\r\n'
+
+# The default maximum size of a project, after it's decompressed.
+MAX_PROJECT_SIZE = 128 * 1024 * 1024
+
+# The zlib window bits of the supported Content-Encodings, deflate
+# accepts both zlib and gzip headers.
+CONTENT_ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': 32 + zlib.MAX_WBITS,
+}
+
+
+class ProjectTooLarge(ValueError):
+    """The body of an upload is larger than its maximum size."""
+
+
+def utf8_boundary(data, start, end):
+    """Return end moved back before an incomplete UTF-8 character."""
+    for back in range(1, min(4, end - start + 1)):
+        byte = ord(data[end - back])
+        if byte < 0x80:
+            break
+        if byte >= 0xc0:
+            length = 2 if byte < 0xe0 else 3 if byte < 0xf0 else 4
+            if back < length:
+                return end - back
+            break
+    return end
+
+
+class JSONProjectDecoder(object):
+    """Decode a JSON object, handing out the project string in pieces.
+
+    feed returns the pieces of the project decoded from the data, as
+    UTF-8.  close returns the other members of the object.
+    """
+
+    def __init__(self):
+        # The body with the project string replaced by null.
+        self.outside = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        self.key = None
+        self.before_project = False
+        self.in_project = False
+        self.found = False
+        # The end of the data that doesn't make a complete piece yet.
+        self.pending = ''
+
+    def feed(self, data):
+        if self.pending:
+            data = self.pending + data
+            self.pending = ''
+        pieces = []
+        position = 0
+        while position < len(data):
+            if self.in_project:
+                position = self.feed_project(data, position, pieces)
+            else:
+                position = self.feed_outside(data, position)
+        return pieces
+
+    def feed_project(self, data, position, pieces):
+        end = STRING_PART.match(data, position).end()
+        if end == len(data):
+            end = utf8_boundary(data, position, end)
+        if end > position:
+            value, _ = json.decoder.scanstring(data[position:end] + '"', 0)
+            pieces.append(value.encode('utf-8'))
+        if end < len(data):
+            if data[end] == '"':
+                self.in_project = False
+                return end + 1
+            if data[end] == '\\' and len(data) - end >= MAX_ESCAPE:
+                raise ValueError("Invalid \\escape in the project: %r"
+                                 % data[end:end + MAX_ESCAPE])
+        self.pending = data[end:]
+        return len(data)
+
+    def feed_outside(self, data, position):
+        outside = self.outside
+        for position in xrange(position, len(data)):
+            char = data[position]
+            if self.in_string:
+                outside.append(char)
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.key = json.loads(
+                            ''.join(outside[self.string_start:]))
+                continue
+            if self.before_project and char not in WHITESPACE:
+                self.before_project = False
+                if char == '"':
+                    outside.append('null')
+                    self.in_project = self.found = True
+                    return position + 1
+            outside.append(char)
+            if char == '"':
+                self.in_string = True
+                self.string_start = len(outside) - 1
+            elif char in '{[':
+                self.depth += 1
+            elif char in '}]':
+                self.depth -= 1
+            elif char == ':' and self.depth == 1:
+                self.before_project = self.key == PROJECT_KEY
+        return len(data)
+
+    def close(self):
+        if self.in_project:
+            raise ValueError("Unterminated project string")
+        fields = json.loads(''.join(self.outside))
+        if not isinstance(fields, dict) or not self.found:
+            raise ValueError("No project string in the request")
+        del fields[PROJECT_KEY]
+        return fields
+
+
+class XMLProjectDecoder(object):
+    """The decoder of a body that is the project itself."""
+
+    def feed(self, data):
+        return [data]
+
+    def close(self):
+        return {}
+
+
+class ProjectUpload(object):
+    """The project of a job, read from the request body.
+
+    The project is hashed and written to a file in directory as the
+    body is fed.  A body starting with { is decoded as JSON,
+    anything else is the project XML.  encoding is the Content-Encoding
+    of the body.  A body larger than max_size once decompressed is
+    rejected with ProjectTooLarge, and is never decompressed further
+    than that.  The first error is kept until close, the rest of the
+    body is ignored.  The phases are measured by profile, see
+    snappy.instrument.
+    """
+
+    def __init__(self, directory, encoding=None, profile=None,
+                 max_size=MAX_PROJECT_SIZE):
+        self.profile = instrument.Profile() if profile is None else profile
+        self.max_size = max_size
+        self.size = 0
+        self.decoder = None
+        self.decompressor = None
+        self.digest = hashlib.sha1()
+        self.fields = None
+        self.error = None
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding in CONTENT_ENCODINGS:
+            self.decompressor = zlib.decompressobj(CONTENT_ENCODINGS[encoding])
+        elif encoding != 'identity':
+            self.error = ValueError("Unsupported Content-Encoding %r"
+                                    % encoding)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, self.filename = tempfile.mkstemp('.xml', dir=directory)
+        self.file = os.fdopen(fd, 'wb')
+
+    def feed(self, data):
+        if self.error is not None:
+            return
+        try:
+            if self.decompressor is not None:
+                with self.profile.phase('decompress'):
+                    # One byte more than the limit is enough to know
+                    # that the body is too large.
+                    data = self.decompressor.decompress(
+                        data, self.max_size - self.size + 1)
+            self.feed_body(data)
+        except Exception as e:
+            self.error = e
+
+    def count(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise ProjectTooLarge("The project is larger than %d bytes"
+                                  % self.max_size)
+
+    def feed_body(self, data):
+        self.count(data)
+        if self.decoder is None:
+            # Whitespace before the project is dropped, it isn't
+            # allowed before an XML declaration.
+            data = data.lstrip()
+            if not data:
+                return
+            if data.startswith('{'):
+                self.decoder = JSONProjectDecoder()
+            else:
+                self.decoder = XMLProjectDecoder()
+        with self.profile.phase('decode'):
+            pieces = self.decoder.feed(data)
+        for piece in pieces:
+            self.write(piece)
+
+    def write(self, xml):
+        self.digest.update(xml)
+        with self.profile.phase('write_xml'):
+            self.file.write(xml)
+
+    def feed_file(self, file, size=64 * 1024):
+        for data in iter(lambda: file.read(size), ''):
+            self.feed(data)
+
+    def close(self):
+        """Finish reading the project and return the other fields.
+
+        Raises the first error found in the body, the file is removed
+        then.
+        """
+        if self.fields is not None:
+            return self.fields
+        try:
+            if self.decompressor is not None and self.error is None:
+                with self.profile.phase('decompress'):
+                    data = self.decompressor.flush()
+                self.feed_body(data)
+            if self.error is not None:
+                raise self.error
+            if self.decoder is None:
+                raise ValueError("The request has no project")
+            with self.profile.phase('decode'):
+                fields = self.decoder.close()
+            self.file.close()
+        except Exception:
+            self.discard()
+            raise
+        self.fields = fields
+        return fields
+
+    def discard(self):
+        """Remove the file of an upload that won't be used."""
+        self.file.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -4,14 +4,26 @@ import os
 import sys
 import uuid
 
+import astor
 from twisted.application import service
-from twisted.internet import reactor, defer, protocol
+from twisted.internet import reactor, defer, protocol, threads
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+from twisted.web import server
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
-import astor
 
+from snappy import cache
+from snappy import compiler
 from snappy import parser
+from snappy import upload
+
+# Directory inside the jobs directory holding the compiled programs.
+CACHE_DIR = '.cache'
+# Directory inside the jobs directory holding projects being uploaded.
+UPLOAD_DIR = '.uploads'
+# The states of a job that has ended.
+DONE_STATES = frozenset(['finished', 'error'])
 
 
 def generate_job_id(jobs_dir):
@@ -23,6 +35,8 @@ def generate_job_id(jobs_dir):
 
 
 def parse_datetime(dt_str):
+    if dt_str is None:
+        return None
     dt, _, us = dt_str.partition(".")
     dt = datetime.datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
     us = int(us.rstrip("Z"), 10)
@@ -99,7 +113,7 @@ class JobProcess(protocol.ProcessProtocol):
 
 class JobHandler(Resource):
 
-    def __init__(self, handler, service, id, body=None):
+    def __init__(self, handler, service, id, upload=None):
         Resource.__init__(self)
         self.state = 'finished'
         self.started = None
@@ -112,14 +126,18 @@ class JobHandler(Resource):
         self.result_file = os.path.join(self.job_dir, 'result.json')
         self.log_file = os.path.join(self.job_dir, 'job.log')
         self.state_file = os.path.join(self.job_dir, 'job.state')
-        if body:
-            self.state = 'stopped'
-            self.startJob(body)
+        # The phases of starting the job, see snappy.instrument.
+        self.profile = []
+        self.deferreds = []
+        if upload:
+            self.state = 'compiling'
+            self.startJob(upload)
         if os.path.exists(self.state_file):
             state = json.load(open(self.state_file))
             self.started = parse_datetime(state['started'])
             self.finished = parse_datetime(state['finished'])
             self.state = state['state']
+            self.profile = state.get('profile', [])
 
     def getChild(self, name, request):
         if name == 'result':
@@ -128,32 +146,91 @@ class JobHandler(Resource):
             return FileResource(self.log_file)
         return NoResource()
 
-    def startJob(self, body):
-        project = json.loads(body)
+    def startJob(self, upload):
+        """Compile and start the project of a finished ProjectUpload.
 
+        The project is compiled on the compile pool of the service, the
+        job is started once it's compiled.
+        """
         os.mkdir(self.job_dir)
-
-        # sprit_id = project['sprite_idx']
-        block_id = project['block_idx']
-
-        # Write uploaded program
-        xml = os.path.join(self.job_dir, 'job.xml')
-        with open(xml, 'w') as file:
-            file.write(project['project'].encode('utf-8'))
-
-        # Parse and write python program
-        p = parser.parses(project['project'].encode('utf-8'))
-        ctx = p.create_context()
-        file_ast = p.to_ast(ctx, 'main_%s' % block_id)
-        code = astor.to_source(file_ast)
-        program = os.path.join(self.job_dir, 'job.py')
-        with open(program, 'w') as file:
-            file.write(code)
+        # The uploaded project was written as it was read.
+        with upload.profile.phase('write_xml'):
+            os.rename(upload.filename, os.path.join(self.job_dir, 'job.xml'))
+        d = threads.deferToThreadPool(reactor, self.service.compile_pool(),
+                                      self.compileJob, upload)
+        d.addCallbacks(self.runJob, self.compileFailed,
+                       callbackArgs=(upload.profile,),
+                       errbackArgs=(upload.profile,))
+        d.addErrback(self.startFailed)
+
+    def compileJob(self, upload):
+        """Write the program of the job and return its filename.
+
+        Called in a thread of the compile pool.  The project is only
+        parsed when its program isn't cached.
+        """
+        profile = upload.profile
+        sprite_id = upload.fields['sprite_idx']
+        block_id = upload.fields['block_idx']
+
+        # Compile and write the program's bytecode, identical
+        # submissions share the compiled program.
+        program_cache = self.service.program_cache
+        optimize = self.service.optimize
+        handler = None
+        with profile.phase('cache'):
+            key = cache.digest_key(upload.digest, block_id, optimize,
+                                   sprite_id)
+            pyc = program_cache.get(key)
+        if pyc is None:
+            handler = self.parseProject(profile)
+            code = compiler.compile_script_code(
+                handler, block_id, optimize, profile=profile,
+                sprite_idx=sprite_id)
+            pyc = compiler.dump_pyc(code, profile)
+            program_cache.set(key, pyc)
+        with profile.phase('write_pyc'):
+            program = os.path.join(self.job_dir, 'job.pyc')
+            with open(program, 'wb') as file:
+                file.write(pyc)
+
+        # The source is only generated to help debugging.
+        if self.service.debug:
+            if handler is None:
+                handler = self.parseProject(profile)
+            with profile.phase('debug_source'):
+                module = compiler.compile_script(
+                    handler, block_id, optimize, sprite_idx=sprite_id)
+                with open(os.path.join(self.job_dir, 'job.py'),
+                          'w') as file:
+                    file.write(astor.to_source(module))
+        return program
+
+    def parseProject(self, profile):
+        with profile.phase('parse'):
+            return parser.parse(os.path.join(self.job_dir, 'job.xml'))
+
+    def runJob(self, program, profile):
+        self.profile = profile.as_list()
         self.job_process = JobProcess(self, self.id)
         reactor.spawnProcess(
             self.job_process, sys.executable,
             [sys.executable, program], env=os.environ)
 
+    def compileFailed(self, reason, profile):
+        log.err(reason, 'Failed to compile job %s' % self.id)
+        self.profile = profile.as_list()
+        self.jobFailed(reason)
+
+    def startFailed(self, reason):
+        log.err(reason, 'Failed to start job %s' % self.id)
+        self.jobFailed(reason)
+
+    def jobFailed(self, reason):
+        with open(self.log_file, 'w') as file:
+            file.write(reason.getTraceback())
+        self.processExited('error')
+
     def processState(self, state):
         self.state = state
         self.started = datetime.datetime.now()
@@ -168,6 +245,17 @@ class JobHandler(Resource):
             del state['result']
         open(self.state_file, 'w').write(json.dumps(state))
         self.handler.unregisterJob(self)
+        deferreds, self.deferreds = self.deferreds, []
+        for d in deferreds:
+            d.callback(self)
+
+    def wait_for(self):
+        """Return a Deferred fired with this handler when the job ends."""
+        if self.state in DONE_STATES:
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self.deferreds.append(d)
+        return d
 
     def state_dict(self):
         state = {'state': self.state,
@@ -175,7 +263,8 @@ class JobHandler(Resource):
                  'started': (self.started.isoformat()
                              if self.started else None),
                  'finished': (self.finished.isoformat()
-                              if self.finished else None)}
+                              if self.finished else None),
+                 'profile': self.profile}
         if os.path.exists(self.result_file):
             result = json.load(open(self.result_file))
             state['result'] = result
@@ -184,9 +273,9 @@ class JobHandler(Resource):
     def render_GET(self, request):
         request.setHeader("Access-Control-Allow-Origin", "*")
         request.setHeader("content-type", "application/json")
-        if self.state == 'finished':
+        if self.state in DONE_STATES:
             return json.dumps(self.state_dict())
-        d = self.job_process.wait_for()
+        d = self.wait_for()
 
         def return_state(result):
             request.write(json.dumps(self.state_dict()))
@@ -201,7 +290,7 @@ class JobsHandler(Resource):
         self.children = {}
 
     def getChild(self, name, request):
-        if name in os.listdir(self.service.jobs_dir):
+        if name in self.service.job_ids():
             return JobHandler(self, self.service, name)
         return NoResource()
 
@@ -211,15 +300,69 @@ class JobsHandler(Resource):
         return json.dumps(
             {'jobs':
              {'running': len(self.children),
-              'completed': len(os.listdir(self.service.jobs_dir))}})
+              'completed': len(self.service.job_ids())},
+             'cache': self.service.program_cache.stats()})
 
     def render_POST(self, request):
+        """Start a job and answer with its id once the body is read.
+
+        Twisted spools the body to a temporary file as it arrives, the
+        project is then decoded, hashed and written to the jobs
+        directory on the compile pool, so the reactor only receives
+        the body.
+        """
         request.setHeader("Access-Control-Allow-Origin", "*")
         request.setHeader("content-type", "application/json")
-        body = request.content.read()
-        id = generate_job_id(self.service.jobs_dir)
-        self.children[id] = JobHandler(self, self.service, id, body)
-        return json.dumps({'id': str(id)})
+        project = self.service.project_upload(
+            request.getHeader('content-encoding'))
+        request.content.seek(0)
+        d = threads.deferToThreadPool(
+            reactor, self.service.compile_pool(), self.read_upload,
+            project, request.content, request.args)
+        d.addCallbacks(self.createJob, self.badRequest,
+                       callbackArgs=(project, request),
+                       errbackArgs=(project, request))
+        return NOT_DONE_YET
+
+    def read_upload(self, project, content, args):
+        """Read the project from content and check the fields of the job.
+
+        Called in a thread of the compile pool.  A project posted as
+        XML has its indexes in the query args.  Raises an exception if
+        the body or the fields aren't valid.
+        """
+        project.feed_file(content)
+        fields = project.close()
+        for name in ('sprite_idx', 'block_idx'):
+            if name in args:
+                fields.setdefault(name, args[name][0])
+        if 'block_idx' not in fields:
+            raise ValueError("The request has no block_idx")
+        fields['block_idx'] = int(fields['block_idx'])
+        fields['sprite_idx'] = int(fields.get('sprite_idx', 0))
+        for name in ('sprite_idx', 'block_idx'):
+            if fields[name] < 0:
+                raise ValueError("The request has a negative %s" % name)
+        return fields
+
+    def createJob(self, fields, project, request):
+        try:
+            id = generate_job_id(self.service.jobs_dir)
+            self.children[id] = JobHandler(self, self.service, id, project)
+        finally:
+            project.discard()
+        request.write(json.dumps({'id': str(id)}))
+        request.finish()
+
+    def badRequest(self, reason, project, request):
+        project.discard()
+        log.msg('Bad job request: %s' % reason.getErrorMessage())
+        if reason.check(upload.ProjectTooLarge):
+            request.setResponseCode(413)
+        else:
+            request.setResponseCode(400)
+        request.write(json.dumps({'error': reason.getErrorMessage()}))
+        request.finish()
 
     def unregisterJob(self, job):
         if job.id in self.children:
@@ -236,11 +379,65 @@ class SnappySite(Resource):
             os.mkdir(self.service.jobs_dir)
 
 
+class SnapSite(server.Site):
+    """The site of a SnapServer."""
+
+    def __init__(self, service, *args, **kwargs):
+        server.Site.__init__(self, service.getResource(), *args, **kwargs)
+        self.service = service
+
+
 class SnapServer(service.Service):
 
-    def __init__(self, jobs_dir='jobs/'):
+    def __init__(self, jobs_dir='jobs/', cache_size=128, debug=False,
+                 optimize=0, compile_threads=4,
+                 max_project_size=upload.MAX_PROJECT_SIZE,
+                 disk_cache_size=1024):
         self.jobs_dir = jobs_dir
+        self.debug = debug
+        self.optimize = optimize
+        # Jobs are compiled on a pool of at most compile_threads
+        # threads, so the reactor keeps serving requests meanwhile.
+        self.compile_threads = compile_threads
+        self._compile_pool = None
+        self.upload_dir = os.path.join(jobs_dir, UPLOAD_DIR)
+        # Larger projects are rejected, however small the compressed
+        # body is.
+        self.max_project_size = max_project_size
+        self.program_cache = cache.ProgramCache(
+            os.path.join(jobs_dir, CACHE_DIR), cache_size, disk_cache_size)
+
+    def job_ids(self):
+        return [name for name in os.listdir(self.jobs_dir)
+                if name not in (CACHE_DIR, UPLOAD_DIR)]
+
+    def project_upload(self, encoding):
+        """Return a ProjectUpload for the body of a new job."""
+        return upload.ProjectUpload(self.upload_dir, encoding,
+                                    max_size=self.max_project_size)
 
     def getResource(self):
         r = SnappySite(self)
         return r
+
+    def getSite(self):
+        return SnapSite(self)
+
+    def compile_pool(self):
+        """Return the thread pool compiling jobs, started on first use."""
+        if self._compile_pool is None:
+            self._compile_pool = ThreadPool(0, self.compile_threads,
+                                            'snappy-compile')
+            self._compile_pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self.stopCompilePool)
+        return self._compile_pool
+
+    def stopCompilePool(self):
+        if self._compile_pool is not None:
+            self._compile_pool.stop()
+            self._compile_pool = None
+
+    def stopService(self):
+        self.stopCompilePool()
+        return service.Service.stopService(self)